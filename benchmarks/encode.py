@@ -0,0 +1,67 @@
+"""
+Compare the encoders of record_video_pil (OpenCV mp4v) and record_video_pipe
+(ffmpeg through a raw video pipe) on synthetic screen frames.
+
+    python -m benchmarks.encode --frames 300 --size 1920 1080
+"""
+import sys
+import resource
+import tempfile
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter, process_time
+
+import numpy as np
+
+from screenio.record import SegmentWriter, PipeWriter
+
+
+def synthetic_frames(count, size=(1280, 720), seed=0):
+    """Screen like frames: a static background with a few changing windows"""
+    width, height = size
+    rng = np.random.default_rng(seed)
+    background = np.tile(np.linspace(0, 255, width, dtype=np.uint8)[None, :, None], (height, 1, 3))
+    for index in range(count):
+        frame = background.copy()
+        x, y = (index * 17) % (width - 200), (index * 11) % (height - 100)
+        frame[y:y + 100, x:x + 200] = rng.integers(0, 255, (100, 200, 3), dtype=np.uint8)
+        frame[10:30, width - 100:width - 10] = index % 256
+        yield frame
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def bench_writer(name, writer, frames):
+    frames = list(frames)
+    start, cpu, child = perf_counter(), process_time(), children_cpu()
+    for frame in frames:
+        writer.write(frame)
+    writer.release()
+    wall = perf_counter() - start
+    cpu = process_time() - cpu + children_cpu() - child
+    return {'name': name, 'fps': len(frames) / wall, 'cpu_ms_per_frame': cpu / len(frames) * 1000}
+
+
+def main(argv=None):
+    parser = ArgumentParser(prog='python -m benchmarks.encode')
+    parser.add_argument('-n', '--frames', type=int, default=120, help='number of frames default=120')
+    parser.add_argument('-s', '--size', type=int, nargs=2, default=[1280, 720], help='frame size default=1280 720')
+    parser.add_argument('--preset', default='veryfast', help='x264 preset for the pipe default=veryfast')
+    args = parser.parse_args(argv if argv is not None else sys.argv[1:])
+    size = tuple(args.size)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = [
+            (bench_writer('pil/mp4v', SegmentWriter(Path(tmp) / 'pil.mp4', 30, size), synthetic_frames(args.frames, size)), Path(tmp) / 'pil.mp4'),
+            (bench_writer('pipe/x264', PipeWriter(Path(tmp) / 'pipe.mkv', size, 30, preset=args.preset), synthetic_frames(args.frames, size)), Path(tmp) / 'pipe.mkv'),
+        ]
+        for result, output in results:
+            result['size_kb'] = output.stat().st_size / 1024
+            print('{name:10} {fps:8.1f} fps {cpu_ms_per_frame:8.2f} ms cpu/frame {size_kb:10.1f} kB'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+"""
+Benchmark suite for the hot paths of screenio. It runs on a headless box,
+the screen is replaced by synthetic frames, the process table by a
+synthetic index and the file system by synthetic event storms. Every
+benchmark runs in its own process, so peak_rss_mb belongs to it alone.
+
+    python -m benchmarks                               # run all
+    python -m benchmarks diff processes                # run some
+    python -m benchmarks --baseline                    # compare, exit 1 on a regression
+    python -m benchmarks --save                        # refresh the baseline
+
+The committed baseline is benchmarks/baseline.json, measured with the
+defaults. Refresh it with --save on the reference machine after a change
+that is meant to move the numbers and commit it together with the change.
+Both options also take another filename. The absolute numbers only hold
+for the reference machine, --save records it under "_machine": a single
+core x86_64 Xeon VM with 5 GB RAM, Linux, Python 3.11, numpy 2.4 and
+OpenCV 5.0, without ffmpeg. The benchmarks in NOT_GATED need ffmpeg, so
+the baseline has no numbers for them and they never fail --baseline.
+"""
+import os
+import sys
+import json
+import platform
+import shutil
+import resource
+import tempfile
+import multiprocessing
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from threading import Event, Thread
+from time import perf_counter, process_time, sleep
+
+from .encode import synthetic_frames, bench_writer
+
+BASELINE = str(Path(__file__).with_name('baseline.json'))
+
+# metrics with these endings are better when they are higher, all others when lower
+HIGHER = ('fps', 'per_s')
+# benchmark.metric prefixes that need ffmpeg, they are reported but not compared
+NOT_GATED = ('concat.', 'encode.x264_')
+
+
+class Skip(Exception):
+    pass
+
+
+class SyntheticSource:
+    """Capture source for the recorders, it sets running after count frames"""
+
+    def __init__(self, count, size, running):
+        self.frames, self.running, self.count = list(synthetic_frames(min(count, 60), size)), running, count
+        self.index = 0
+
+    def read(self):
+        frame = self.frames[self.index % len(self.frames)]
+        self.index += 1
+        if self.index >= self.count:
+            self.running.set()
+        return frame
+
+    def close(self):
+        pass
+
+
+def percentiles(samples, prefix=''):
+    samples = sorted(samples)
+    return {'{}p{}_ms'.format(prefix, q): samples[min(len(samples) - 1, len(samples) * q // 100)] * 1000 for q in (50, 95, 99)}
+
+
+def histogram_p95(stats, stage):
+    """Upper bound of the bucket with the 95th percentile of a RecordStats histogram"""
+    counts = stats.histogram.get(stage)
+    if not counts:
+        return 0.0
+    total, limit = 0, sum(counts) * 0.95
+    for bound, count in zip(stats.buckets + (float('inf'),), counts):
+        total += count
+        if total >= limit:
+            return bound * 1000
+    return 0.0
+
+
+def bench_record_pil(frames, size):
+    """record_video_pil from a synthetic source with diff and mp4v encoding, no frame rate limit"""
+    from screenio.record import record_video_pil
+    from screenio.utils import RecordStats
+    stats, running = RecordStats(), Event()
+    source = SyntheticSource(frames, size, running)
+    with tempfile.TemporaryDirectory() as tmp:
+        start, cpu = perf_counter(), process_time()
+        record_video_pil(str(Path(tmp) / 'out.mp4'), dt=0, running=running, stats=stats, source=source)
+        wall, cpu = perf_counter() - start, process_time() - cpu
+    return {
+        'fps': source.index / wall,
+        'cpu_ms_per_frame': cpu / source.index * 1000,
+        'written': stats.written,
+        'diff_p95_ms': histogram_p95(stats, 'diff'),
+        'write_p95_ms': histogram_p95(stats, 'write'),
+    }
+
+
+def bench_diff(frames, size):
+    """ChangeDetector on changing frames"""
+    from screenio.record import ChangeDetector
+    detector, samples = ChangeDetector(), []
+    data = list(synthetic_frames(min(frames, 60), size))
+    cpu = process_time()
+    for index in range(frames):
+        start = perf_counter()
+        detector(data[index % len(data)])
+        samples.append(perf_counter() - start)
+    cpu = process_time() - cpu
+    return dict(percentiles(samples), fps=len(samples) / sum(samples), cpu_ms_per_frame=cpu / len(samples) * 1000)
+
+
+def bench_processes(frames, size, procs=5000, files=20):
+    """Scan of the real process table and the rule check against a synthetic one"""
+    from screenio.procs import ProcessIndex, check_processes
+    index = ProcessIndex()
+    start = perf_counter()
+    index.update()
+    full = perf_counter() - start
+    start = perf_counter()
+    index.update()
+    incremental = perf_counter() - start
+
+    fake = ProcessIndex()
+    for pid in range(procs):
+        name = 'proc{}'.format(pid % 500)
+        fake.procs[pid] = name
+        fake.names.setdefault(name, set()).add(pid)
+        fake.paths += [('/home/user/project{}/file{}.py'.format(pid, item), pid) for item in range(files)]
+    fake.paths.sort()
+    rules = (['proc7', 'proc42'], ['/home/user/project4711/'], ['firefox'], ['/home/user/secret'])
+    samples = []
+    for _ in range(max(frames, 100)):
+        start = perf_counter()
+        check_processes(*rules, index=fake)
+        samples.append(perf_counter() - start)
+    return dict(percentiles(samples, 'check_'), scan_ms=full * 1000, update_ms=incremental * 1000, checks_per_s=len(samples) / sum(samples))
+
+
+def bench_file_events(frames, size, events=200000, threads=4):
+    """Storm of file system events on the FileSystemTrigger callback"""
+    try:
+        from screenio.config import Config
+        from screenio.triggers import FileSystemTrigger
+    except ImportError as exc:
+        raise Skip(exc)
+    activated = []
+    with tempfile.TemporaryDirectory() as tmp:
+        conf = {'storm': {'file_system_dir': tmp, 'file_system_dt': 5, 'file_system_debounce': 0.05}}
+        trigger = FileSystemTrigger(Config(conf), lambda sender, name, event: activated.append(perf_counter()), dt=1)
+        sleep(0.2)
+
+        def storm():
+            for _ in range(events // threads):
+                trigger.on_action('storm', None)
+
+        workers = [Thread(target=storm) for _ in range(threads)]
+        start = perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        wall = perf_counter() - start
+        while not activated and perf_counter() - start < 5:
+            sleep(0.01)
+        trigger.close()
+        trigger.join()
+    return {
+        'events_per_s': trigger.received / wall,
+        'coalesced': trigger.coalesced,
+        'activation_ms': (activated[0] - start) * 1000 if activated else float('nan'),
+    }
+
+
+def bench_encode(frames, size):
+    """OpenCV mp4v against x264 through the ffmpeg pipe"""
+    from screenio.record import SegmentWriter, PipeWriter
+    result = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        writers = [('mp4v', lambda: SegmentWriter(Path(tmp) / 'pil.mp4', 30, size))]
+        if shutil.which('ffmpeg'):
+            writers.append(('x264', lambda: PipeWriter(Path(tmp) / 'pipe.mkv', size, 30)))
+        for name, writer in writers:
+            data = bench_writer(name, writer(), synthetic_frames(frames, size))
+            result['{}_fps'.format(name)] = data['fps']
+            result['{}_cpu_ms_per_frame'.format(name)] = data['cpu_ms_per_frame']
+    return result
+
+
+def bench_concat(frames, size, segments=8):
+    """concat_videos_ffmpeg over segments with the same codec parameters"""
+    if not shutil.which('ffmpeg') or not shutil.which('ffprobe'):
+        raise Skip('no ffmpeg')
+    from screenio.record import PipeWriter
+    from screenio.convert import concat_videos_ffmpeg
+    with tempfile.TemporaryDirectory() as tmp:
+        parts = Path(tmp) / 'parts'
+        parts.mkdir()
+        for index in range(segments):
+            writer = PipeWriter(parts / '{:03d}.mkv'.format(index), size, 30)
+            for frame in synthetic_frames(max(frames // segments, 1), size, index):
+                writer.write(frame)
+            writer.release()
+        start = perf_counter()
+        concat_videos_ffmpeg(str(parts), str(Path(tmp) / 'out.mkv'), quiet=True)
+        return {'wall_ms': (perf_counter() - start) * 1000}
+
+
+BENCHMARKS = {
+    'record-pil': bench_record_pil,
+    'diff': bench_diff,
+    'processes': bench_processes,
+    'file-events': bench_file_events,
+    'encode': bench_encode,
+    'concat': bench_concat,
+}
+
+
+def run_benchmark(name, frames, size):
+    try:
+        result = BENCHMARKS[name](frames, size)
+    except Skip as exc:
+        return {'skipped': str(exc)}
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    result['peak_rss_mb'] = usage.ru_maxrss / 1024
+    return result
+
+
+def run_isolated(name, frames, size):
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(run_benchmark, name, frames, size).result()
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Return (name, metric, baseline, value, change) of the metrics that got worse by more than tolerance"""
+    regressions = []
+    for name, metrics in results.items():
+        for key, value in metrics.items():
+            if '{}.{}'.format(name, key).startswith(NOT_GATED):
+                continue
+            old = baseline.get(name, {}).get(key)
+            if not isinstance(old, (int, float)) or not isinstance(value, (int, float)) or not old or value != value:
+                continue
+            change = (value - old) / abs(old)
+            if (-change if key.endswith(HIGHER) else change) > tolerance:
+                regressions.append((name, key, old, value, change))
+    return regressions
+
+
+def machine():
+    """Description of this machine for the baseline"""
+    cpu = platform.processor()
+    try:
+        with open('/proc/cpuinfo') as fh:
+            cpu = next(line.split(':', 1)[1].strip() for line in fh if line.startswith('model name'))
+    except (OSError, StopIteration):
+        pass
+    versions = {}
+    for module in ('numpy', 'cv2'):
+        try:
+            versions[module] = __import__(module).__version__
+        except ImportError:
+            versions[module] = None
+    return dict(versions, cpu=cpu, cpus=os.cpu_count(), platform=platform.platform(), python=platform.python_version(), ffmpeg=bool(shutil.which('ffmpeg')))
+
+
+def main(argv=None):
+    parser = ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument('names', nargs='*', metavar='name', help='benchmarks to run: {} default=all'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('-n', '--frames', type=int, default=300, help='number of frames default=300')
+    parser.add_argument('-s', '--size', type=int, nargs=2, default=[1280, 720], help='frame size default=1280 720')
+    parser.add_argument('--baseline', nargs='?', const=BASELINE, help='compare with this baseline json default={}'.format(BASELINE))
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed change against the baseline default=0.2')
+    parser.add_argument('--save', nargs='?', const=BASELINE, help='write the results as baseline json default={}'.format(BASELINE))
+    args = parser.parse_args(argv if argv is not None else sys.argv[1:])
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmarks {}'.format(', '.join(unknown)))
+
+    results = {}
+    for name in args.names or BENCHMARKS:
+        results[name] = result = run_isolated(name, args.frames, tuple(args.size))
+        if 'skipped' in result:
+            print('{:12} skipped: {}'.format(name, result['skipped']))
+            continue
+        for key, value in result.items():
+            print('{:12} {:24} {:12.3f}'.format(name, key, value))
+
+    if args.save:
+        Path(args.save).write_text(json.dumps(dict(results, _machine=machine()), indent=2, sort_keys=True))
+    if args.baseline:
+        regressions = compare(results, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        for name, key, old, value, change in regressions:
+            print('REGRESSION {} {}: {:.3f} -> {:.3f} ({:+.0%})'.format(name, key, old, value, change))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
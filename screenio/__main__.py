@@ -23,7 +23,7 @@ def main(argv=None):
     if args.command:
         setup_logger(args.verbose)
         try:
-            return commands[args.command](args.argv)
+            return commands[args.command].load()(args.argv)
         except Exception as exc:
             if args.verbose:
                 raise
@@ -0,0 +1,109 @@
+import os
+from collections import namedtuple
+from collections.abc import Mapping
+from logging import getLogger
+from types import MappingProxyType
+
+import toml
+
+logger = getLogger(__name__)
+
+TRIGGERS = ('MouseKeyboardTrigger', 'ProcessesTrigger', 'FileSystemTrigger')
+
+
+class Profile(namedtuple('Profile', 'name conf mask required_proc required_files banned_proc banned_files')):
+    """Compiled profile, mask has a bit for every trigger listed in triggers"""
+    __slots__ = ()
+
+    @property
+    def proc_rules(self):
+        return bool(self.required_proc or self.required_files or self.banned_proc or self.banned_files)
+
+    @property
+    def proc_files(self):
+        return bool(self.required_files or self.banned_files)
+
+    def active(self, mask):
+        """True if the triggers in mask start the recorder, any trigger without a triggers list"""
+        return (mask & self.mask) == self.mask if self.mask else mask != 0
+
+
+class Config(Mapping):
+    """
+    Immutable compiled config, a mapping profile name -> read-only conf.
+
+    The trigger names get a bit each, so the state of a profile is an int and
+    the check if it is active is one and. select() returns the profiles a
+    trigger can affect at all, computed once for the known triggers. A
+    changed file is compiled into a new Config and diff() names the profiles
+    whose recorders need a restart.
+    """
+
+    def __init__(self, data, filename=None, mtime=None):
+        data = dict(data)
+        default = data.pop('default', {})
+        self.filename, self.mtime = filename, mtime
+        names = list(TRIGGERS)
+        for conf in data.values():
+            names += [name for name in conf.get('triggers', default.get('triggers', [])) if name not in names]
+        self.bits = MappingProxyType({name: 1 << index for index, name in enumerate(names)})
+        # bit for senders that are not in the config, it only counts for profiles without triggers list
+        self.other = 1 << len(names)
+
+        profiles = {}
+        for name, conf in data.items():
+            conf = MappingProxyType(dict(default, **conf))
+            logger.debug('name=%s data=%s', name, dict(conf))
+            profiles[name] = Profile(
+                name, conf, self.mask(conf.get('triggers', [])),
+                frozenset(conf.get('required_proc', [])), tuple(conf.get('required_proc_files', [])),
+                frozenset(conf.get('banned_proc', [])), tuple(conf.get('banned_proc_files', [])),
+            )
+        self.profiles = MappingProxyType(profiles)
+        self._select = {name: self._profiles_for(name) for name in TRIGGERS}
+
+    @classmethod
+    def load(cls, filename='screenio.toml'):
+        mtime = os.stat(filename).st_mtime_ns
+        return cls(toml.load(filename), filename, mtime)
+
+    def changed_on_disk(self):
+        try:
+            return os.stat(self.filename).st_mtime_ns != self.mtime
+        except OSError:
+            return False
+
+    def __getitem__(self, name):
+        return self.profiles[name].conf
+
+    def __iter__(self):
+        return iter(self.profiles)
+
+    def __len__(self):
+        return len(self.profiles)
+
+    def bit(self, sender):
+        return self.bits.get(sender, self.other)
+
+    def mask(self, senders):
+        mask = 0
+        for sender in senders:
+            mask |= self.bit(sender)
+        return mask
+
+    def senders(self, mask):
+        return [name for name, bit in self.bits.items() if mask & bit] + (['other'] if mask & self.other else [])
+
+    def _profiles_for(self, trigger):
+        bit = self.bit(trigger)
+        return tuple(profile for profile in self.profiles.values() if not profile.mask or profile.mask & bit)
+
+    def select(self, trigger):
+        """Profiles that trigger can activate or deactivate"""
+        if trigger not in self._select:
+            return self._profiles_for(trigger)
+        return self._select[trigger]
+
+    def diff(self, other):
+        """Names of the profiles that are new, gone or changed in other"""
+        return {name for name in set(self.profiles) | set(other.profiles) if self.get(name) != other.get(name)}
@@ -1,60 +1,327 @@
+import os
 import sys
+import json
+import tempfile
 from argparse import ArgumentParser
 from pathlib import Path
 from logging import getLogger
+from collections import deque, Counter
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import ffmpeg
-from moviepy.editor import ImageSequenceClip
 
 from .utils import create_parsers_ffmpeg
+from .store import FrameStore, is_store
+from .record import TIMESTAMPS
 
 logger = getLogger(__name__)
 
+CHECK_INDEX = '.screenio-check.json'
+FRAME_SUFFIXES = ('.png', '.webp', '.ppm', '.jpg')
 
-def check_video_file_ffmpeg(filename):
-    filename = Path(filename).resolve()
+
+def inspect_video_ffmpeg(filename, full=False):
+    """
+    Return the parameters of the first video stream or None for a broken file.
+
+    The cheap check reads the header with ffprobe and decodes only the last
+    second, which catches files cut off by a crash. Files without a duration
+    or with full=True are decoded completely.
+    """
+    filename = str(Path(filename).resolve())
     try:
-        ffmpeg.input(str(filename)).output("null", f="null").run()
-    except ffmpeg._run.Error:
+        info = ffmpeg.probe(filename)
+        stream = next(item for item in info['streams'] if item.get('codec_type') == 'video')
+        params = {key: stream.get(key) for key in ('codec_name', 'profile', 'level', 'width', 'height', 'pix_fmt', 'r_frame_rate', 'time_base')}
+        duration = float(info['format'].get('duration') or 0)
+        if full or duration <= 0:
+            ffmpeg.input(filename).output('null', f='null').run(quiet=True)
+        else:
+            ffmpeg.input(filename, sseof=-min(1, duration)).output('null', f='null').run(quiet=True)
+    except (ffmpeg.Error, StopIteration, KeyError, ValueError):
         logger.info('file "%s" is broken', filename)
-        return False
+        return None
     logger.debug('file "%s" is okay', filename)
-    return True
+    return params
+
+
+def check_video_file_ffmpeg(filename, full=True):
+    return inspect_video_ffmpeg(filename, full) is not None
+
+
+def check_videos_ffmpeg(directory='.', workers=None, full=False, exclude=()):
+    """
+    Inspect all files in directory with a process pool and return a dict
+    filename -> stream parameters of the okay videos. The results are cached
+    in a sidecar index keyed by name, size and mtime, so unchanged files are
+    not checked again.
+    """
+    directory = Path(directory).resolve()
+    index_file = directory / CHECK_INDEX
+    try:
+        index = json.loads(index_file.read_text())
+    except (OSError, ValueError):
+        index = {}
+
+    files, todo = {}, []
+    for path in directory.iterdir():
+        if not path.is_file() or path.name.startswith('.') or path in exclude:
+            continue
+        stat = path.stat()
+        files[path.name] = key = [stat.st_size, stat.st_mtime]
+        cached = index.get(path.name)
+        if cached is None or cached['key'] != key or (full and not cached.get('full')):
+            todo.append(path)
+    logger.debug('check %i of %i files in "%s"', len(todo), len(files), directory)
+
+    if todo:
+        with ProcessPoolExecutor(workers) as executor:
+            for path, params in zip(todo, executor.map(inspect_video_ffmpeg, todo, [full] * len(todo))):
+                index[path.name] = {'key': files[path.name], 'full': full, 'params': params}
+    index = {name: value for name, value in index.items() if name in files}
+    try:
+        index_file.write_text(json.dumps(index))
+    except OSError as exc:
+        logger.warning('can not write "%s": %s', index_file, exc)
+    return {str(directory / name): value['params'] for name, value in index.items() if value['params'] is not None}
+
 
+def params_key(params):
+    return tuple(sorted(params.items()))
 
-def concat_videos_ffmpeg(directory='.', output='out.mp4', quiet=False):
+
+def group_videos(records):
+    """Split the sorted dict filename -> params into runs with the same params"""
+    groups, last = [], None
+    for filename, params in sorted(records.items()):
+        key = params_key(params)
+        if key != last:
+            groups.append([])
+            last = key
+        groups[-1].append(filename)
+    return groups
+
+
+def write_concat_list(filename, records):
+    Path(filename).write_text(''.join("file '{}'\n".format(str(record).replace("'", "'\\''")) for record in records))
+
+
+def concat_copy_ffmpeg(records, output, quiet=False):
+    """Concat videos with the same codec parameters with the concat demuxer and without re-encoding"""
+    with tempfile.TemporaryDirectory() as tmp:
+        concat_list = Path(tmp) / 'concat.txt'
+        write_concat_list(concat_list, records)
+        stream = ffmpeg.input(str(concat_list), f='concat', safe=0)
+        stream = ffmpeg.output(stream, str(output), c='copy')
+        ffmpeg.run(stream, overwrite_output=True, quiet=quiet)
+
+
+def concat_filter_ffmpeg(records, output, params, quiet=False):
+    """
+    Decode the videos, scale them to the size, frame rate and pix_fmt of
+    params and join them with the concat filter into one new stream. Unlike
+    the concat demuxer this works for inputs with other profiles or codec
+    extradata (SPS/PPS).
+    """
+    streams = [
+        ffmpeg.input(str(record)).video
+        .filter('scale', params['width'], params['height'])
+        .filter('setsar', 1)
+        .filter('fps', params['r_frame_rate'])
+        .filter('format', params['pix_fmt'])
+        for record in records
+    ]
+    stream = ffmpeg.concat(*streams, v=1, a=0)
+    stream = ffmpeg.output(stream, str(output), vcodec=params['codec_name'], pix_fmt=params['pix_fmt'])
+    ffmpeg.run(stream, overwrite_output=True, quiet=quiet)
+
+
+def concat_videos_ffmpeg(directory='.', output='out.mp4', quiet=False, workers=None, full=False):
     directory = Path(directory).resolve()
     output = Path(output).resolve()
-    records = [str(rec) for rec in directory.iterdir() if check_video_file_ffmpeg(rec)]
+    records = check_videos_ffmpeg(directory, workers, full, exclude=[output])
     if not records:
         logger.debug('no videos in directory "%s"', directory)
         return
-    records.sort()
-    logger.debug('records=%s', records)
-    stream = ffmpeg.input(records[0])
-    for video in records[1:]:
-        stream = stream.concat(ffmpeg.input(video))
-    stream = ffmpeg.output(stream, str(output))
-    ffmpeg.run(stream, overwrite_output=True, quiet=quiet)
+    groups = group_videos(records)
+    logger.debug('groups=%s', groups)
+    if len(groups) == 1:
+        concat_copy_ffmpeg(groups[0], output, quiet)
+        return
+
+    # the runs are joined by stream copy first, a re-encoded stream would
+    # not share the extradata of the others, so the runs are then joined
+    # with the concat filter to the most common parameters
+    main = dict(Counter(params_key(params) for params in records.values()).most_common(1)[0][0])
+    with tempfile.TemporaryDirectory(dir=str(output.parent)) as tmp:
+        parts = []
+        for index, group in enumerate(groups):
+            if len(group) == 1:
+                parts.append(group[0])
+                continue
+            parts.append(str(Path(tmp) / '{:03d}{}'.format(index, Path(group[0]).suffix)))
+            logger.debug('join %i files to %s', len(group), parts[-1])
+            concat_copy_ffmpeg(group, parts[-1], quiet)
+        concat_filter_ffmpeg(parts, output, main, quiet)
 
 
 def frames_to_video_moviepy(directory='frames', output='out.mp4', fps=30):
+    from moviepy.editor import ImageSequenceClip
     directory = Path(directory).resolve()
     logger.debug('directory=%s', directory)
-    files = [str(file) for file in directory.iterdir()]
-    files.sort()
+    files = list(iter_frame_files(directory))
     clip = ImageSequenceClip(files, fps=fps)
     clip.write_videofile(str(output))
 
 
-def frames_to_video_ffmpeg(directory='frames', output='out.mp4', fps=30, vcodec='libx264', pix_fmt='yuv420p'):
+def frames_to_video_ffmpeg(directory='frames', output='out.mp4', fps=30, vcodec='libx264', pix_fmt='yuv420p', max_gap=10):
+    """
+    The frames of a frame store or a directory with timestamps.csv are
+    listed for the concat demuxer, each one shown until the next frame was
+    captured, otherwise the numbered frames are read at fps.
+    """
     directory = Path(directory).resolve()
+    if is_store(directory) or (directory / TIMESTAMPS).is_file():
+        with tempfile.TemporaryDirectory() as tmp:
+            concat_list = Path(tmp) / 'frames.txt'
+            with open(str(concat_list), 'w') as fh:
+                for filename, count in frame_counts(iter_timed_frames(directory), fps, max_gap):
+                    if count:
+                        fh.write("file '{}'\nduration {}\n".format(filename.replace("'", "'\\''"), count / fps))
+            stream = ffmpeg.input(str(concat_list), f='concat', safe=0)
+            stream = ffmpeg.output(stream, str(output), vcodec=vcodec, pix_fmt=pix_fmt, r=fps)
+            ffmpeg.run(stream, overwrite_output=True)
+        return
     filename = str(directory / '%06d.png')
     stream = ffmpeg.input(filename=filename, f='image2').setpts('N/TB/{}'.format(fps))
     stream = ffmpeg.output(stream, output, vcodec=vcodec, pix_fmt=pix_fmt, r=fps)
     ffmpeg.run(stream, overwrite_output=True)
 
 
+def iter_frame_files(directory='frames'):
+    """Frame files in directory in sorted order, the numbering may have gaps, or the frames of a FrameStore from its index"""
+    if is_store(directory):
+        yield from FrameStore(directory).frames()
+        return
+    with os.scandir(str(directory)) as entries:
+        names = sorted(entry.name for entry in entries if entry.is_file() and entry.name.lower().endswith(FRAME_SUFFIXES))
+    for name in names:
+        yield os.path.join(str(directory), name)
+
+
+def read_timestamps(filename):
+    """Frame name -> wall clock time from a timestamps.csv, broken lines are skipped"""
+    timestamps = {}
+    try:
+        fh = open(str(filename))
+    except FileNotFoundError:
+        return timestamps
+    with fh:
+        for line in fh:
+            name, _, timestamp = line.rstrip('\n').partition(',')
+            try:
+                timestamps[name] = float(timestamp)
+            except ValueError:
+                continue
+    return timestamps
+
+
+def iter_timed_frames(directory='frames'):
+    """(filename, timestamp) of the frames like iter_frame_files, the timestamp is None if it was not recorded"""
+    if is_store(directory):
+        for _, path, timestamp, _ in FrameStore(directory).entries():
+            yield path, timestamp
+        return
+    timestamps = read_timestamps(Path(directory) / TIMESTAMPS)
+    for filename in iter_frame_files(directory):
+        yield filename, timestamps.get(os.path.basename(filename))
+
+
+def frame_counts(frames, fps, max_gap=10):
+    """
+    Yield (filename, count) with the number of video frames at fps for each
+    (filename, timestamp), so every frame lasts until the next one. Gaps
+    are cut to max_gap seconds, like the pause between two recordings, and
+    frames without a timestamp last 1/fps. The counts are rounded on the
+    running position, so they do not drift, a count can be 0.
+    """
+    position, total, last = 0.0, 0, None
+    for filename, timestamp in frames:
+        if last is not None:
+            gap = timestamp - last[1] if timestamp is not None and last[1] is not None else 1 / fps
+            position += min(max(gap, 0), max_gap)
+            count = round(position * fps) - total
+            total += count
+            yield last[0], count
+        last = (filename, timestamp)
+    if last is not None:
+        yield last[0], 1
+
+
+def load_frame(filename, size):
+    """Decode a frame to raw rgb24 bytes with the given size"""
+    from PIL import Image
+    with Image.open(filename) as img:
+        img = img.convert('RGB')
+        if img.size != size:
+            img = img.resize(size)
+        return img.tobytes()
+
+
+def imap_bounded(executor, func, iterable, window):
+    """Like executor.map, but with at most window items in flight"""
+    futures = deque()
+    for item in iterable:
+        futures.append(executor.submit(func, item))
+        if len(futures) >= window:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+def frames_to_video_pipe(directory='frames', output='out.mp4', fps=30, vcodec='libx264', pix_fmt='yuv420p', workers=4, max_gap=10):
+    """
+    Decode the frames with a thread pool and stream them as raw video into
+    the stdin of ffmpeg. Only a few frames are in memory at any time. Every
+    frame is repeated until the timestamp of the next one, see frame_counts.
+    """
+    from PIL import Image
+    frames = (item for item in frame_counts(iter_timed_frames(Path(directory).resolve()), fps, max_gap) if item[1])
+    first = next(frames, None)
+    if first is None:
+        logger.debug('no frames in directory "%s"', directory)
+        return
+    with Image.open(first[0]) as img:
+        size = img.size
+
+    def load(item):
+        return load_frame(item[0], size), item[1]
+    logger.debug('size=%s, fps=%s, output=%s', size, fps, output)
+
+    stream = ffmpeg.input('pipe:', f='rawvideo', pix_fmt='rgb24', s='{}x{}'.format(*size), framerate=fps)
+    # yuv420p needs an even width and height
+    stream = stream.filter('pad', 'ceil(iw/2)*2', 'ceil(ih/2)*2')
+    stream = ffmpeg.output(stream, str(output), vcodec=vcodec, pix_fmt=pix_fmt, r=fps)
+    process = ffmpeg.run_async(stream, pipe_stdin=True, overwrite_output=True)
+    try:
+        with ThreadPoolExecutor(workers) as executor:
+            for data, count in imap_bounded(executor, load, chain([first], frames), 2 * workers):
+                for _ in range(count):
+                    process.stdin.write(data)
+    except BrokenPipeError:
+        # ffmpeg exited early, its exit code is reported below
+        pass
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = process.wait()
+    if returncode:
+        raise RuntimeError('ffmpeg exited with {}'.format(returncode))
+
+
 def main(argv=None):
     parser = ArgumentParser(prog='screenio convert')
     subparsers = parser.add_subparsers(dest='kind')
@@ -66,18 +333,29 @@ def main(argv=None):
     subparsers_ffmpeg = create_parsers_ffmpeg(subparsers, 'frames-ffmpeg', ['out'])
     subparsers_ffmpeg.add_argument('-i', '--input', default='frames', help='input dir')
     subparsers_ffmpeg.add_argument('-o', '--output', default='out.mp4', help='output file')
+    subparsers_ffmpeg.add_argument('--max-gap', type=float, default=10, help='show a frame at most n seconds without a newer one default=10')
+
+    subparsers_pipe = create_parsers_ffmpeg(subparsers, 'frames-pipe', ['out'])
+    subparsers_pipe.add_argument('-i', '--input', default='frames', help='input dir')
+    subparsers_pipe.add_argument('-o', '--output', default='out.mp4', help='output file')
+    subparsers_pipe.add_argument('-w', '--workers', type=int, default=4, help='number of decode threads default=4')
+    subparsers_pipe.add_argument('--max-gap', type=float, default=10, help='show a frame at most n seconds without a newer one default=10')
 
     subparsers_concat = subparsers.add_parser('concat')
     subparsers_concat.add_argument('input', help='input dir')
     subparsers_concat.add_argument('output', default='out.mp4', help='output file')
+    subparsers_concat.add_argument('-w', '--workers', type=int, help='number of check processes default=cpu count')
+    subparsers_concat.add_argument('--full', action='store_true', help='decode every file completely to check it')
 
     args = parser.parse_args(argv if argv is not None else sys.argv[1:])
     if args.kind == 'frames-moviepy':
         frames_to_video_moviepy(args.input, args.output, args.framerate)
     elif args.kind == 'frames-ffmpeg':
-        frames_to_video_ffmpeg(args.input, args.output, args.framerate, args.vcodec, args.pix_fmt)
+        frames_to_video_ffmpeg(args.input, args.output, args.framerate, args.vcodec, args.pix_fmt, args.max_gap)
+    elif args.kind == 'frames-pipe':
+        frames_to_video_pipe(args.input, args.output, args.framerate, args.vcodec, args.pix_fmt, args.workers, args.max_gap)
     elif args.kind == 'concat':
-        concat_videos_ffmpeg(args.input, args.output)
+        concat_videos_ffmpeg(args.input, args.output, workers=args.workers, full=args.full)
     else:
         parser.print_help()
 
@@ -0,0 +1,65 @@
+from logging import getLogger
+from threading import Thread, Event
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .record import PilSource, HUB_HEADER
+from .utils import RecordStats, Scheduler
+
+logger = getLogger(__name__)
+
+
+class CaptureHub(Thread):
+    """
+    Grab the screen once per tick into a shared memory ring buffer.
+
+    Recorders read the newest frame with HubSource, from threads or other
+    processes, with their own rate, regions and scale. So the screen is
+    grabbed only once per tick no matter how many recorders are running.
+    Every slot carries the sequence of its frame, a reader copies its crop
+    and checks the sequence again to detect a slot that was overwritten.
+    """
+
+    def __init__(self, dt=1, size=None, xdisplay=None, slots=4, name=None):
+        super().__init__(daemon=True)
+        self.dt, self.running, self.stats = dt, Event(), RecordStats()
+        self.source = PilSource(size, xdisplay, 'BGR', self.stats)
+        frame = self.source.read()
+        header = 8 * (HUB_HEADER + slots)
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=header + slots * frame.nbytes)
+        self.name = self.shm.name
+        self.header = np.ndarray((HUB_HEADER + slots,), np.int64, self.shm.buf)
+        self.frames = np.ndarray((slots,) + frame.shape, np.uint8, self.shm.buf, offset=header)
+        x0, y0 = self.source.size[:2] if self.source.size else (0, 0)
+        self.header[:HUB_HEADER] = (0, frame.shape[0], frame.shape[1], slots, x0, y0)
+        self.header[HUB_HEADER:] = -1
+        self.publish(frame)
+        logger.info('start capture hub name=%s, shape=%s, slots=%i', self.name, frame.shape, slots)
+        self.start()
+
+    def publish(self, frame):
+        seq = int(self.header[0]) + 1
+        slot = HUB_HEADER + seq % int(self.header[3])
+        self.header[slot] = -1
+        self.frames[slot - HUB_HEADER] = frame
+        self.header[slot] = seq
+        self.header[0] = seq
+
+    def run(self):
+        scheduler = Scheduler(self.dt, self.running)
+        while scheduler.wait():
+            try:
+                self.publish(self.source.read())
+            except ValueError as exc:
+                logger.warning('skip frame with a different shape: %s', exc)
+            except Exception as exc:
+                logger.exception('capture failed: %s', exc)
+
+    def close(self):
+        self.running.set()
+        self.join()
+        del self.header, self.frames
+        self.shm.close()
+        self.shm.unlink()
+        logger.info('end capture hub %s', self.stats)
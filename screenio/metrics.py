@@ -0,0 +1,133 @@
+import sys
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger
+from threading import Thread, get_ident
+from time import sleep, monotonic
+from urllib.parse import urlparse, parse_qs
+
+from .utils import RecordStats
+
+logger = getLogger(__name__)
+
+RECORDER_COUNTERS = ('captured', 'skipped', 'written', 'dropped', 'missed', 'errors', 'repeated', 'deduplicated', 'bytes_copied', 'bytes_written')
+RECORDER_GAUGES = ('queue_depth', 'interval', 'fps')
+
+
+def format_labels(labels):
+    return ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels.items())
+
+
+def render_metrics(octopus):
+    """Prometheus text format of the recorders, triggers and profiles of an Octopus"""
+    lines = []
+
+    def metric(name, kind, helptext, samples):
+        lines.append('# HELP screenio_{} {}'.format(name, helptext))
+        lines.append('# TYPE screenio_{} {}'.format(name, kind))
+        for labels, value, *suffix in samples:
+            labels = '{{{}}}'.format(format_labels(labels)) if labels else ''
+            lines.append('screenio_{}{}{} {}'.format(name, suffix[0] if suffix else '', labels, value))
+
+    workers = list(octopus.worker.items())
+    status = {name: worker.status for name, worker in workers}
+    metric('recorder_up', 'gauge', 'recorder is running', [({'profile': name}, int(worker.is_alive())) for name, worker in workers])
+    for key in RECORDER_COUNTERS:
+        metric('recorder_{}_total'.format(key), 'counter', 'recorder {} counter'.format(key.replace('_', ' ')),
+               [({'profile': name}, data.get(key, 0)) for name, data in status.items()])
+    for key in RECORDER_GAUGES:
+        metric('recorder_{}'.format(key), 'gauge', 'recorder {}'.format(key.replace('_', ' ')),
+               [({'profile': name}, data.get(key, 0)) for name, data in status.items()])
+
+    samples = []
+    for name, data in status.items():
+        for stage, latency in sorted(data.get('latency', {}).items()):
+            labels, total = {'profile': name, 'stage': stage}, 0
+            for bound, count in zip(RecordStats.buckets + ('+Inf',), latency['buckets']):
+                total += count
+                samples.append((dict(labels, le=bound), total, '_bucket'))
+            samples.append((labels, latency['sum'], '_sum'))
+            samples.append((labels, total, '_count'))
+    metric('recorder_latency_seconds', 'histogram', 'latency of the pipeline stages', samples)
+
+    triggers = [(trigger.__class__.__name__, trigger.metrics()) for trigger in octopus.triggers]
+    for key, kind in (('ticks', 'counter'), ('tick_seconds', 'counter'), ('tick_max_seconds', 'gauge'), ('events', 'counter'),
+                      ('received', 'counter'), ('coalesced', 'counter')):
+        name = 'trigger_{}{}'.format(key, '_total' if kind == 'counter' else '')
+        metric(name, kind, 'trigger {}'.format(key.replace('_', ' ')), [({'trigger': trigger}, data[key]) for trigger, data in triggers if key in data])
+
+    metric('profile_trigger_mask', 'gauge', 'bitmask of the active triggers of a profile', [({'profile': name}, mask) for name, mask in list(octopus.trigger.items())])
+    metric('events_total', 'counter', 'trigger events processed by the octopus', [({}, octopus.events_processed)])
+    return '\n'.join(lines) + '\n'
+
+
+def sample_stacks(seconds=5, interval=0.01):
+    """
+    Sample the stacks of all threads of this process and return them in the
+    collapsed format of flamegraph.pl, one 'frame;frame;frame count' per line.
+    Recorders running in their own process are not visible here.
+    """
+    stacks, own, end = Counter(), get_ident(), monotonic() + seconds
+    while monotonic() < end:
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            names = []
+            while frame is not None:
+                names.append('{} ({}:{})'.format(frame.f_code.co_name, frame.f_code.co_filename, frame.f_lineno))
+                frame = frame.f_back
+            stacks[';'.join(reversed(names))] += 1
+        sleep(interval)
+    return ''.join('{} {}\n'.format(stack, count) for stack, count in stacks.most_common())
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/metrics':
+            body, content_type = render_metrics(self.server.octopus), 'text/plain; version=0.0.4'
+        elif url.path == '/profile':
+            try:
+                seconds = float(parse_qs(url.query).get('seconds', [5])[0])
+            except ValueError:
+                seconds = float('nan')
+            if not seconds > 0:
+                self.send_error(400, 'seconds must be a positive number')
+                return
+            body, content_type = sample_stacks(min(seconds, 60)), 'text/plain'
+        else:
+            self.send_error(404)
+            return
+        data = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class MetricsServer(Thread):
+    """
+    Serve /metrics in the Prometheus text format and /profile?seconds=n, a
+    sampling profile of all threads, on a local address.
+    """
+
+    def __init__(self, octopus, address='127.0.0.1:9101'):
+        super().__init__(daemon=True)
+        host, _, port = address.rpartition(':')
+        self.server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), MetricsHandler)
+        self.server.daemon_threads = True
+        self.server.octopus = octopus
+        logger.info('serve metrics on http://%s:%i/metrics', *self.server.server_address[:2])
+        self.start()
+
+    def run(self):
+        self.server.serve_forever()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
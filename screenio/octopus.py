@@ -1,80 +1,186 @@
 import sys
+import asyncio
 from argparse import ArgumentParser
 from logging import getLogger
-from time import sleep
+from threading import Event
 
 import toml
 
-from .utils import FuncRunner, check_triggers
+from .config import Config
+from .utils import FuncRunner
 from .triggers import ProcessesTrigger, FileSystemTrigger, MouseKeyboardTrigger
 
 logger = getLogger(__name__)
 
 
 class Octopus:
-    """docstring for Octopus."""
+    """
+    Start and stop the recorders of the profiles in config on trigger events.
+
+    The triggers run in their own threads, but they only post their events to
+    a queue of the asyncio loop. The events are processed in order on the
+    loop, so the state in trigger and worker is changed from one thread only
+    and a recorder starts as soon as the event arrives. The recorders are
+    FuncRunner threads or processes, a finished recorder is removed, so the
+    next trigger event can start it again.
+
+    The state of a profile is the bitmask of its active triggers. The config
+    file is checked every reload_dt seconds, on a change only the recorders
+    of the changed profiles are stopped.
+    """
     trigger_cls = [
         MouseKeyboardTrigger,
         ProcessesTrigger,
         FileSystemTrigger,
     ]
 
-    def __init__(self, config='screenio.toml', dt=60):
+    def __init__(self, config='screenio.toml', dt=60, hub_dt=None, reload_dt=5, metrics=None):
         super(Octopus, self).__init__()
-        self.config = toml.load(config)
-        default = self.config.pop('default', {})
-        for data in self.config.values():
-            for key, value in default.items():
-                data.setdefault(key, value)
-        for key, value in self.config.items():
-            logger.debug('name=%s data=%s', key, value)
-        self.dt, self.worker, self.trigger = dt, {}, {}
-        self.triggers = [cls(self.config, self.on_trigger) for cls in self.trigger_cls]
+        self.config, self.reload_dt, self.metrics = Config.load(config), reload_dt, metrics
+        self.events_processed, self.metrics_server = 0, None
+        self.dt, self.worker, self.trigger, self.stopping = dt, {}, {}, []
+        self.running, self.loop, self.events, self.stopped = Event(), None, None, None
+        self.hub = None
+        if hub_dt:
+            from .hub import CaptureHub
+            self.hub = CaptureHub(hub_dt)
+        self.triggers = []
+
+    def post(self, sender, name, event):
+        """Called by the trigger threads"""
+        if self.running.is_set():
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.events.put_nowait, (sender, name, event))
+        except RuntimeError:
+            logger.debug('loop closed, drop event sender=%s, name=%s', sender, name)
 
     def on_trigger(self, sender, name, event):
         logger.info('on_trigger sender=%s, name=%s, event=%s', sender, name, event)
-        trigger = self.trigger.get(name, [])
-        if event and sender not in trigger:
-            trigger.append(sender)
-            if check_triggers(trigger, self.config[name].get('triggers', [])) and name not in self.worker:
+        profile = self.config.profiles.get(name)
+        if profile is None:
+            return
+        bit, mask = self.config.bit(sender), self.trigger.get(name, 0)
+        if event and not mask & bit:
+            mask |= bit
+            if profile.active(mask) and name not in self.worker:
+                kwargs = dict(profile.conf.get('kwargs', {}))
+                if self.hub is not None and profile.conf.get('hub'):
+                    kwargs.setdefault('source', 'hub:' + self.hub.name)
                 self.worker[name] = FuncRunner(
-                    self.config[name].get('func'),
-                    self.config[name].get('directory', '.'),
-                    self.config[name].get('filename', '{}.mp4'),
-                    self.config[name].get('kwargs', {})
+                    profile.conf.get('func'),
+                    profile.conf.get('directory', '.'),
+                    profile.conf.get('filename', '{}.mp4'),
+                    kwargs,
+                    profile.conf.get('process', False),
                 )
-        elif not event and sender in trigger:
-            trigger.remove(sender)
-            if not check_triggers(trigger, self.config[name].get('triggers', [])) and name in self.worker:
-                thread = self.worker.pop(name)
-                thread.stop()
+        elif not event and mask & bit:
+            mask &= ~bit
+            if not profile.active(mask) and name in self.worker:
+                self.stop_worker(name)
+
+        self.trigger[name] = mask
 
-        self.trigger[name] = trigger
+    def stop_worker(self, name):
+        thread = self.worker.pop(name)
+        thread.stop()
+        self.stopping.append(thread)
+
+    def reload(self):
+        try:
+            config = Config.load(self.config.filename)
+        except (OSError, toml.TomlDecodeError) as exc:
+            logger.warning('keep the old config, can not load "%s": %s', self.config.filename, exc)
+            return
+        changed = self.config.diff(config)
+        logger.info('reload config, changed profiles %s', sorted(changed))
+        for name in changed:
+            if name in self.worker:
+                self.stop_worker(name)
+            self.trigger.pop(name, None)
+        # the bits may differ in the new config
+        self.trigger = {name: config.mask(self.config.senders(mask)) for name, mask in self.trigger.items()}
+        self.config = config
+        for trigger in self.triggers:
+            trigger.reload(config, changed)
 
     def on_trigger_mouse(self, name, event):
         self.on_trigger('mouse', name, event)
 
-    def wait(self):
+    def stop(self):
+        self.running.set()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    def reap(self):
+        for name, worker in list(self.worker.items()):
+            if not worker.is_alive():
+                logger.warning('worker %s ended with status %s', name, worker.status)
+                del self.worker[name]
+            else:
+                logger.debug('worker %s status %s', name, worker.status)
+        self.stopping = [thread for thread in self.stopping if thread.is_alive()]
+
+    async def process_events(self):
+        while True:
+            sender, name, event = await self.events.get()
+            self.events_processed += 1
+            self.on_trigger(sender, name, event)
+
+    async def watch_config(self):
         while True:
-            try:
+            await asyncio.sleep(self.reload_dt)
+            if self.config.changed_on_disk():
+                self.reload()
+
+    async def run(self):
+        self.loop, self.events, self.stopped = asyncio.get_running_loop(), asyncio.Queue(), asyncio.Event()
+        self.triggers = [cls(self.config, self.post) for cls in self.trigger_cls]
+        if self.metrics:
+            from .metrics import MetricsServer
+            self.metrics_server = MetricsServer(self, self.metrics)
+        tasks = [self.loop.create_task(self.process_events())]
+        if self.reload_dt:
+            tasks.append(self.loop.create_task(self.watch_config()))
+        try:
+            while not self.running.is_set():
                 logger.debug('current trigger %s', self.trigger)
-                for _ in range(self.dt):
-                    sleep(1)
-            except KeyboardInterrupt:
-                break
-        for trigger in self.triggers:
-            trigger.close()
-        for thread in self.worker.values():
-            thread.stop()
-            thread.join()
+                self.reap()
+                try:
+                    await asyncio.wait_for(self.stopped.wait(), self.dt)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.running.set()
+            for task in tasks:
+                task.cancel()
+            for trigger in self.triggers:
+                trigger.close()
+            for thread in self.worker.values():
+                thread.stop()
+            for thread in list(self.worker.values()) + self.stopping + self.triggers:
+                await self.loop.run_in_executor(None, thread.join)
+            if self.hub is not None:
+                self.hub.close()
+            if self.metrics_server is not None:
+                self.metrics_server.close()
+
+    def wait(self):
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            logger.info('break with KeyboardInterrupt')
 
 
 def main(argv=None):
     parser = ArgumentParser(prog='screenio dynamic')
     parser.add_argument('-c', '--config', default='screenio.toml', help='config file')
     parser.add_argument('-t', '--dt', type=int, default=60, help='delta time default=60')
+    parser.add_argument('--hub-dt', type=float, help='grab the screen once every n seconds for all profiles with hub = true')
+    parser.add_argument('--reload-dt', type=float, default=5, help='check the config file for changes every n seconds, 0 disables default=5')
+    parser.add_argument('--metrics', metavar='HOST:PORT', help='serve /metrics and /profile on this address, e.g. 127.0.0.1:9101')
     args = parser.parse_args(argv if argv is not None else sys.argv[1:])
-    octopus = Octopus(args.config, args.dt)
+    octopus = Octopus(args.config, args.dt, args.hub_dt, args.reload_dt, args.metrics)
     octopus.wait()
 
 
@@ -0,0 +1,168 @@
+import socket
+import struct
+from bisect import bisect_left
+from select import select
+from time import monotonic
+
+
+class ProcessIndex:
+    """
+    Incremental index of the running processes.
+
+    update() compares the pid list with the last call and only looks at new
+    and exited processes. names maps process names to pids and paths is a
+    sorted list of (path, pid) tuples of the open files for prefix lookups
+    with bisect. Open files are only collected if asked for and cached per
+    (pid, create_time) for files_ttl seconds, because open_files() is the
+    expensive part. A known pid with another create_time was reused and
+    counts as exited and new, only the rechecked pids are compared, or all
+    pids with verify=True.
+    """
+
+    def __init__(self, files_ttl=30):
+        self.files_ttl, self.names, self.paths = files_ttl, {}, []
+        self.procs, self.created, self.fresh, self._files = {}, {}, set(), {}
+
+    @staticmethod
+    def _create_time(pid):
+        import psutil
+        try:
+            return psutil.Process(pid).create_time()
+        except psutil.Error:
+            return None
+
+    def _remove(self, pid):
+        name = self.procs.pop(pid, None)
+        self.created.pop(pid, None)
+        if name in self.names:
+            self.names[name].discard(pid)
+            if not self.names[name]:
+                del self.names[name]
+
+    def _add(self, pid):
+        import psutil
+        try:
+            proc = psutil.Process(pid)
+            name, created = proc.name(), proc.create_time()
+        except psutil.Error:
+            return
+        self.procs[pid], self.created[pid] = name, created
+        self.names.setdefault(name, set()).add(pid)
+
+    def update(self, files=False, recheck=(), verify=False):
+        """
+        Update the index and return True if it changed. Pids in recheck and
+        pids that were new on the last call are read again, because a
+        process may exec a new program under the same pid right after fork.
+        """
+        import psutil
+        pids, now = set(psutil.pids()), monotonic()
+        recheck = (self.fresh | set(recheck)) & pids
+        known = pids & set(self.procs)
+        reused = {pid for pid in (known if verify else recheck & known) if self._create_time(pid) != self.created[pid]}
+        gone, new = set(self.procs) - pids | reused, pids - set(self.procs) | reused
+        recheck -= new
+        names = {pid: self.procs.get(pid) for pid in recheck}
+        for pid in gone | recheck:
+            # an exec'ed program has other open files under the same key
+            self._files.pop((pid, self.created.get(pid)), None)
+            self._remove(pid)
+        for pid in new | recheck:
+            self._add(pid)
+        changed = bool(gone or new) or any(self.procs.get(pid) != name for pid, name in names.items())
+        self.fresh = new
+
+        if files:
+            files_changed, cache = bool(gone), {}
+            for pid, created in self.created.items():
+                key = (pid, created)
+                cached = self._files.get(key)
+                if cached is None or now - cached[0] > self.files_ttl:
+                    try:
+                        paths = [item.path for item in psutil.Process(pid).open_files()]
+                    except Exception:
+                        paths = []
+                    files_changed = files_changed or cached is None or cached[1] != paths
+                    cached = (now, paths)
+                cache[key] = cached
+            self._files = cache
+            if files_changed:
+                self.paths = sorted((path, pid) for (pid, _), (_, paths) in cache.items() for path in paths)
+            changed = changed or files_changed
+        return changed
+
+    def has_name(self, name):
+        return name in self.names
+
+    def has_path(self, prefix):
+        index = bisect_left(self.paths, (prefix,))
+        return index < len(self.paths) and self.paths[index][0].startswith(prefix)
+
+
+class ProcConnector:
+    """
+    Process fork/exec/exit notifications from the Linux netlink process
+    connector. Opening it needs CAP_NET_ADMIN, so callers should fall back
+    to polling on OSError.
+    """
+    NETLINK_CONNECTOR, CN_IDX_PROC, CN_VAL_PROC = 11, 1, 1
+    NLMSG_DONE, PROC_CN_MCAST_LISTEN, PROC_CN_MCAST_IGNORE = 3, 1, 2
+    PROC_EVENT_FORK, PROC_EVENT_EXEC, PROC_EVENT_EXIT = 0x1, 0x2, 0x80000000
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, self.NETLINK_CONNECTOR)
+        try:
+            self.sock.bind((0, self.CN_IDX_PROC))
+            self._send(self.PROC_CN_MCAST_LISTEN)
+        except OSError:
+            self.sock.close()
+            raise
+        self.sock.setblocking(False)
+
+    def _send(self, op):
+        data = struct.pack('=IIIIHHI', self.CN_IDX_PROC, self.CN_VAL_PROC, 0, 0, 4, 0, op)
+        self.sock.send(struct.pack('=IHHII', 16 + len(data), self.NLMSG_DONE, 0, 0, 0) + data)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def wait(self, timeout=1):
+        """Wait for events and return the pids that forked, exec'ed or exited"""
+        pids = set()
+        if not select([self.sock], [], [], timeout)[0]:
+            return pids
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except BlockingIOError:
+                return pids
+            # nlmsghdr (16) + cn_msg (20) + proc_event: what, cpu, timestamp, data
+            if len(data) < 60:
+                continue
+            what = struct.unpack_from('=I', data, 36)[0]
+            if what == self.PROC_EVENT_FORK:
+                pids.add(struct.unpack_from('=I', data, 60)[0] if len(data) >= 64 else 0)
+            elif what in (self.PROC_EVENT_EXEC, self.PROC_EVENT_EXIT):
+                pids.add(struct.unpack_from('=I', data, 56)[0])
+            pids.discard(0)
+
+    def close(self):
+        try:
+            self._send(self.PROC_CN_MCAST_IGNORE)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def check_processes(required=[], required_files=[], banned=[], banned_files=[], index=None):
+    if not required and not required_files and not banned and not banned_files:
+        return True
+    try:
+        if index is None:
+            index = ProcessIndex()
+            index.update(files=bool(required_files or banned_files))
+    except Exception:
+        return True
+    if any(index.has_name(name) for name in banned) or any(index.has_path(name) for name in banned_files):
+        return False
+    return all(index.has_name(name) for name in required) and all(index.has_path(name) for name in required_files)
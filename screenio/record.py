@@ -1,109 +1,817 @@
+import os
 import sys
+import ctypes
+import multiprocessing
+from ctypes.util import find_library
 from argparse import ArgumentParser
-from time import sleep
 from pathlib import Path
 from logging import getLogger
+from time import time, monotonic
+from threading import Thread, Condition, Lock
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
-import cv2
-import numpy as np
 import ffmpeg
-from PIL.ImageGrab import grab
 
-from .utils import create_parsers_pil, create_parsers_ffmpeg, format_now
+from .utils import create_parsers_pil, create_parsers_ffmpeg, create_parsers_capture, create_parsers_video, format_now, capture_regions, RecordStats, FramePipeline
+from .store import FrameStore
 
 logger = getLogger(__name__)
 
+FRAME_FORMATS = {'png': '.png', 'webp': '.webp', 'raw': '.ppm'}
+TIMESTAMPS = 'timestamps.csv'
+# header of the CaptureHub memory: sequence, height, width, slots, x0, y0 followed by the sequence of every slot
+HUB_HEADER = 6
 
-def record_video_pil(output='out.mp4', size=None, dt=1, framerate=30, difference=True, xdisplay=None, running=None):
-    current_img = last_img = grab(size, xdisplay=xdisplay)
+
+class ChangeDetector:
+    """
+    Tile based difference check for numpy frames.
+
+    The absolute difference to the last accepted frame is reduced to one
+    value per tile. A frame counts as changed if more than `threshold` tiles
+    differ, or, with `mean` set, if the mean absolute difference is above
+    `mean`. With `scale` > 1 both frames are downscaled by area averaging
+    first, a change of only a few pixels by a few levels can be averaged
+    away then.
+    """
+
+    def __init__(self, tile=32, threshold=0, mean=0.0, scale=1):
+        self.tile, self.threshold, self.mean, self.scale = tile, threshold, mean, max(1, int(scale))
+        self.last, self.changed_tiles, self.mean_diff = None, 0, 0.0
+
+    def prepare(self, frame):
+        import numpy as np
+        frame = np.asarray(frame)
+        if self.scale > 1:
+            import cv2
+            size = (max(1, frame.shape[1] // self.scale), max(1, frame.shape[0] // self.scale))
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        return frame
+
+    def compare(self, frame):
+        """Update the tile statistic and return True if the frame changed"""
+        import cv2
+        import numpy as np
+        diff = cv2.absdiff(frame, self.last)
+        if self.mean:
+            self.mean_diff = float(diff.mean())
+            return self.mean_diff > self.mean
+        # numpy is slow reducing a size 3 last axis, the channels of a tile
+        # are reduced as columns of a (h, w * channels) view instead
+        height, width = diff.shape[:2]
+        channels = diff.shape[2] if diff.ndim == 3 else 1
+        diff = diff.reshape(height, width * channels)
+        rows = np.arange(0, height, self.tile)
+        cols = np.arange(0, width * channels, self.tile * channels)
+        tiles = np.maximum.reduceat(np.maximum.reduceat(diff, rows, axis=0), cols, axis=1)
+        self.changed_tiles = int(np.count_nonzero(tiles))
+        return self.changed_tiles > self.threshold
+
+    def __call__(self, frame):
+        """Return True if the frame should be written, it becomes the new reference then"""
+        frame = self.prepare(frame)
+        if self.last is None or self.last.shape != frame.shape or self.compare(frame):
+            self.last = frame
+            return True
+        return False
+
+
+def union_bbox(bboxes):
+    return (min(b[0] for b in bboxes), min(b[1] for b in bboxes), max(b[2] for b in bboxes), max(b[3] for b in bboxes))
+
+
+def compose_regions(frame, crops):
+    """Cut the crops (x0, y0, x1, y1) out of frame and place them side by side"""
+    import numpy as np
+    parts = [frame[y0:y1, x0:x1] for x0, y0, x1, y1 in crops]
+    composed = np.zeros((max(part.shape[0] for part in parts), sum(part.shape[1] for part in parts), 3), np.uint8)
+    x = 0
+    for part in parts:
+        composed[:part.shape[0], x:x + part.shape[1]] = part
+        x += part.shape[1]
+    return composed
+
+
+def scale_frame(frame, scale):
+    """Resize the frame with area averaging"""
+    import cv2
+    size = (max(1, round(frame.shape[1] * scale)), max(1, round(frame.shape[0] * scale)))
+    return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+
+def open_source(source=None, size=None, xdisplay=None, mode='BGR', stats=None, regions=None, scale=1):
+    """
+    Create the capture source:
+    None or 'pil' grabs with PIL, 'xshm' with the X11 MIT-SHM extension,
+    'ffmpeg:<format>:<input>' reads an ffmpeg input like 'ffmpeg:x11grab::99'
+    or 'ffmpeg:v4l2:/dev/video0', 'hub:<name>' reads from a CaptureHub and an
+    iterable of numpy frames is recorded as it is. An object with read() is
+    used directly.
+    """
+    regions = list(regions or []) or ([tuple(size)] if size else [])
+    if source is None or source == 'pil':
+        return PilSource(None, xdisplay, mode, stats, regions, scale)
+    if source == 'xshm':
+        return XShmSource(None, xdisplay, mode, stats, regions, scale)
+    if isinstance(source, str) and source.startswith('ffmpeg:'):
+        f, _, filename = source[7:].partition(':')
+        return FfmpegSource(filename, f, None, mode=mode, stats=stats, regions=regions, scale=scale)
+    if isinstance(source, str) and source.startswith('hub:'):
+        return HubSource(source[4:], mode, stats, regions, scale)
+    if hasattr(source, 'read'):
+        return source
+    if hasattr(source, '__iter__') and not isinstance(source, str):
+        return GeneratorSource(source, mode, stats, regions, scale)
+    raise ValueError('unknown capture source "{}"'.format(source))
+
+
+def first_then(frame, read):
+    """Capture function that returns the already read frame first, so a finite source loses nothing"""
+    frames = [frame]
+
+    def capture():
+        return frames.pop() if frames else read()
+    return capture
+
+
+class CaptureSource:
+    """
+    Base class of the capture sources.
+
+    grab() returns the frame of the bounding box of all regions, or of the
+    whole screen, as numpy array in the channel order of mode. read() places
+    several regions side by side and scales the frame, so the diff and the
+    encoders get the same frames from every source. A source that runs out
+    of frames raises EOFError.
+    """
+
+    def __init__(self, size=None, mode='BGR', stats=None, regions=None, scale=1):
+        regions = list(regions or []) or ([tuple(size)] if size else [])
+        self.size = union_bbox(regions) if regions else None
+        self.mode, self.scale = mode, scale
+        self.stats = stats if stats is not None else RecordStats()
+        self.crops = []
+        if len(regions) > 1:
+            x, y = self.size[:2]
+            self.crops = [(x0 - x, y0 - y, x1 - x, y1 - y) for x0, y0, x1, y1 in regions]
+
+    def grab(self):
+        raise NotImplementedError
+
+    def read(self):
+        frame = self.grab()
+        self.stats.captured += 1
+        self.stats.bytes_copied += frame.nbytes
+        if self.crops:
+            frame = compose_regions(frame, self.crops)
+        if self.scale != 1:
+            frame = scale_frame(frame, self.scale)
+        return frame
+
+    def close(self):
+        pass
+
+
+class PilSource(CaptureSource):
+    """
+    Screen capture with PIL.
+
+    The grab is converted once by the PIL raw encoder into the requested
+    channel order and the frame is a read-only numpy view on these bytes, so
+    it can go to the diff and the encoder without any further copy.
+    """
+
+    def __init__(self, size=None, xdisplay=None, mode='BGR', stats=None, regions=None, scale=1):
+        super().__init__(size, mode, stats, regions, scale)
+        self.xdisplay = xdisplay
+
+    def grab(self):
+        import numpy as np
+        from PIL.ImageGrab import grab
+        img = grab(self.size, xdisplay=self.xdisplay)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        data = img.tobytes('raw', self.mode)
+        return np.frombuffer(data, np.uint8).reshape(img.size[1], img.size[0], 3)
+
+
+class XImage(ctypes.Structure):
+    _fields_ = [
+        ('width', ctypes.c_int),
+        ('height', ctypes.c_int),
+        ('xoffset', ctypes.c_int),
+        ('format', ctypes.c_int),
+        ('data', ctypes.c_void_p),
+        ('byte_order', ctypes.c_int),
+        ('bitmap_unit', ctypes.c_int),
+        ('bitmap_bit_order', ctypes.c_int),
+        ('bitmap_pad', ctypes.c_int),
+        ('depth', ctypes.c_int),
+        ('bytes_per_line', ctypes.c_int),
+        ('bits_per_pixel', ctypes.c_int),
+    ]
+
+
+class XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [
+        ('shmseg', ctypes.c_ulong),
+        ('shmid', ctypes.c_int),
+        ('shmaddr', ctypes.c_void_p),
+        ('readOnly', ctypes.c_int),
+    ]
+
+
+class XShmSource(CaptureSource):
+    """
+    Screen capture with the MIT-SHM extension of the X server.
+
+    The X server writes the screen directly into a shared memory segment, so
+    there is no XGetImage round trip over the socket. The segment is reused
+    for every grab, the frame is copied out of it while dropping the padding
+    byte of the 32 bit pixels.
+    """
+    ZPixmap, IPC_CREAT, IPC_RMID = 2, 0o1000, 0
+
+    def __init__(self, size=None, xdisplay=None, mode='BGR', stats=None, regions=None, scale=1):
+        super().__init__(size, mode, stats, regions, scale)
+        try:
+            self.xlib = ctypes.cdll.LoadLibrary(find_library('X11') or 'libX11.so.6')
+            self.xext = ctypes.cdll.LoadLibrary(find_library('Xext') or 'libXext.so.6')
+            self.libc = ctypes.CDLL(find_library('c'), use_errno=True)
+        except OSError as exc:
+            raise OSError('can not load libX11/libXext: {}'.format(exc)) from exc
+        xlib, xext, libc = self.xlib, self.xext, self.libc
+        xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        xlib.XOpenDisplay.restype = ctypes.c_void_p
+        for name in ('XDefaultScreen', 'XDefaultDepth', 'XDisplayWidth', 'XDisplayHeight'):
+            getattr(xlib, name).argtypes = [ctypes.c_void_p] + ([ctypes.c_int] if name != 'XDefaultScreen' else [])
+        xlib.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        xlib.XDefaultRootWindow.restype = ctypes.c_ulong
+        xlib.XDefaultVisual.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDefaultVisual.restype = ctypes.c_void_p
+        xlib.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XFree.argtypes = [ctypes.c_void_p]
+        xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+        xext.XShmCreateImage.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p,
+                                         ctypes.POINTER(XShmSegmentInfo), ctypes.c_uint, ctypes.c_uint]
+        xext.XShmCreateImage.restype = ctypes.POINTER(XImage)
+        xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.POINTER(XShmSegmentInfo)]
+        xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.POINTER(XShmSegmentInfo)]
+        xext.XShmGetImage.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(XImage), ctypes.c_int, ctypes.c_int, ctypes.c_ulong]
+        libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        libc.shmat.restype = ctypes.c_void_p
+        libc.shmdt.argtypes = [ctypes.c_void_p]
+        libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+
+        self.display = xlib.XOpenDisplay(xdisplay.encode() if xdisplay else None)
+        if not self.display:
+            raise OSError('can not open display {}'.format(xdisplay or os.environ.get('DISPLAY')))
+        self.image, self.shminfo = None, XShmSegmentInfo()
+        try:
+            if not xext.XShmQueryExtension(self.display):
+                raise OSError('no MIT-SHM extension')
+            screen = xlib.XDefaultScreen(self.display)
+            self.root = xlib.XDefaultRootWindow(self.display)
+            if self.size is None:
+                self.size = (0, 0, xlib.XDisplayWidth(self.display, screen), xlib.XDisplayHeight(self.display, screen))
+            x0, y0, x1, y1 = self.size
+            self.image = xext.XShmCreateImage(self.display, xlib.XDefaultVisual(self.display, screen), xlib.XDefaultDepth(self.display, screen),
+                                              self.ZPixmap, None, ctypes.byref(self.shminfo), x1 - x0, y1 - y0)
+            if not self.image or self.image.contents.bits_per_pixel != 32:
+                raise OSError('MIT-SHM needs a 24/32 bit screen')
+            image = self.image.contents
+            self.shminfo.shmid = libc.shmget(0, image.bytes_per_line * image.height, self.IPC_CREAT | 0o600)
+            if self.shminfo.shmid < 0:
+                raise OSError(ctypes.get_errno(), 'shmget failed')
+            self.shminfo.shmaddr = image.data = libc.shmat(self.shminfo.shmid, None, 0)
+            self.shminfo.readOnly = 0
+            attached = xext.XShmAttach(self.display, ctypes.byref(self.shminfo))
+            xlib.XSync(self.display, 0)
+            # removed as soon as both sides detached, even if this process dies
+            libc.shmctl(self.shminfo.shmid, self.IPC_RMID, None)
+            if not attached:
+                raise OSError('XShmAttach failed')
+        except Exception:
+            self.close()
+            raise
+        import numpy as np
+        buffer = (ctypes.c_uint8 * (image.bytes_per_line * image.height)).from_address(image.data)
+        self.buffer = np.frombuffer(buffer, np.uint8).reshape(image.height, image.bytes_per_line // 4, 4)[:, :image.width]
+
+    def grab(self):
+        import cv2
+        x0, y0 = self.size[:2]
+        if not self.xext.XShmGetImage(self.display, self.root, self.image, x0, y0, 0xffffffff):
+            raise OSError('XShmGetImage failed')
+        return cv2.cvtColor(self.buffer, cv2.COLOR_BGRA2RGB if self.mode == 'RGB' else cv2.COLOR_BGRA2BGR)
+
+    def close(self):
+        if self.image:
+            if self.shminfo.shmaddr:
+                self.xext.XShmDetach(self.display, ctypes.byref(self.shminfo))
+                self.libc.shmdt(self.shminfo.shmaddr)
+                self.shminfo.shmaddr = None
+            self.xlib.XFree(self.image)
+            self.image = None
+        if self.display:
+            self.xlib.XCloseDisplay(self.display)
+            self.display = None
+
+
+class FfmpegSource(CaptureSource):
+    """
+    Read raw frames from any ffmpeg input, e.g. x11grab on a Xvfb display,
+    v4l2 or a file. With latest=True a reader thread keeps only the newest
+    frame, so a slow recorder gets the current picture instead of a backlog.
+    The size of the input is probed if there are no regions.
+    """
+
+    def __init__(self, filename=':0', f='x11grab', size=None, framerate=30, mode='BGR', stats=None, regions=None, scale=1, latest=True):
+        super().__init__(size, mode, stats, regions, scale)
+        options = {'framerate': framerate} if f in ('x11grab', 'v4l2') else {}
+        if self.size is None:
+            stream = next(item for item in ffmpeg.probe(filename, f=f)['streams'] if item.get('codec_type') == 'video')
+            self.size = (0, 0, int(stream['width']), int(stream['height']))
+        x0, y0, x1, y1 = self.size
+        self.shape = (y1 - y0, x1 - x0, 3)
+        if f == 'x11grab':
+            stream = ffmpeg.input('{}+{},{}'.format(filename, x0, y0), f=f, video_size=(x1 - x0, y1 - y0), **options)
+        else:
+            stream = ffmpeg.input(filename, f=f, **options).crop(x0, y0, x1 - x0, y1 - y0)
+        stream = ffmpeg.output(stream, 'pipe:', f='rawvideo', pix_fmt='rgb24' if mode == 'RGB' else 'bgr24')
+        self.process = ffmpeg.run_async(stream.global_args('-nostats', '-loglevel', 'error'), pipe_stdout=True)
+        self.nbytes = self.shape[0] * self.shape[1] * 3
+        self.latest, self.data, self.seq, self.last, self.eof = latest, None, 0, 0, False
+        if latest:
+            self.cond = Condition()
+            self.reader = Thread(target=self.run, daemon=True)
+            self.reader.start()
+
+    def run(self):
+        while True:
+            data = self.process.stdout.read(self.nbytes)
+            if len(data) < self.nbytes:
+                break
+            with self.cond:
+                self.data, self.seq = data, self.seq + 1
+                self.cond.notify_all()
+        with self.cond:
+            self.eof = True
+            self.cond.notify_all()
+
+    def grab(self):
+        import numpy as np
+        if self.latest:
+            with self.cond:
+                self.cond.wait_for(lambda: self.seq != self.last or self.eof)
+                if self.seq == self.last:
+                    raise EOFError('ffmpeg input ended')
+                data, self.last = self.data, self.seq
+        else:
+            data = self.process.stdout.read(self.nbytes)
+            if len(data) < self.nbytes:
+                raise EOFError('ffmpeg input ended')
+        return np.frombuffer(data, np.uint8).reshape(self.shape)
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+        if self.latest:
+            self.reader.join()
+        self.process.stdout.close()
+
+
+class GeneratorSource(CaptureSource):
+    """Record an iterable of BGR numpy frames, e.g. rendered by the application itself"""
+
+    def __init__(self, frames, mode='BGR', stats=None, regions=None, scale=1):
+        super().__init__(None, mode, stats, regions, scale)
+        self.frames = iter(frames)
+
+    def grab(self):
+        import numpy as np
+        try:
+            frame = next(self.frames)
+        except StopIteration:
+            raise EOFError('frame source ended') from None
+        if self.size is not None:
+            x0, y0, x1, y1 = self.size
+            frame = frame[y0:y1, x0:x1]
+        if self.mode == 'RGB':
+            frame = frame[..., ::-1]
+        return np.ascontiguousarray(frame)
+
+
+def attach_shared_memory(name):
+    """
+    Attach to an existing block. Before python 3.13 the block is registered
+    with the resource tracker, which is shared with the child processes of
+    the hub, so it is still only unlinked by the hub.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+class HubSource(CaptureSource):
+    """
+    Read the newest frame of a CaptureHub, regions are absolute screen
+    bboxes. Every slot carries the sequence of its frame, the crop is copied
+    and the sequence checked again to detect a slot that was overwritten.
+    """
+
+    def __init__(self, name, mode='BGR', stats=None, regions=None, scale=1, retries=8):
+        import numpy as np
+        super().__init__(None, mode, stats, regions, scale)
+        self.shm, self.retries = attach_shared_memory(name), retries
+        shape = np.ndarray((HUB_HEADER,), np.int64, self.shm.buf)
+        height, width, slots, self.x, self.y = (int(value) for value in shape[1:HUB_HEADER])
+        del shape
+        self.header = np.ndarray((HUB_HEADER + slots,), np.int64, self.shm.buf)
+        self.frames = np.ndarray((slots, height, width, 3), np.uint8, self.shm.buf, offset=8 * (HUB_HEADER + slots))
+
+    def grab(self):
+        import numpy as np
+        for _ in range(self.retries):
+            seq = int(self.header[0])
+            slot = HUB_HEADER + seq % len(self.frames)
+            frame = self.frames[slot - HUB_HEADER]
+            if self.size is not None:
+                x0, y0, x1, y1 = self.size
+                frame = frame[y0 - self.y:y1 - self.y, x0 - self.x:x1 - self.x]
+            frame = np.ascontiguousarray(frame[..., ::-1]) if self.mode == 'RGB' else frame.copy()
+            if int(self.header[slot]) == seq:
+                return frame
+        raise RuntimeError('capture hub overwrites the frames faster than they can be read')
+
+    def close(self):
+        del self.header, self.frames
+        self.shm.close()
+
+
+class FrameFiller:
+    """
+    Write every frame at the position of its capture timestamp. The last
+    frame is repeated for the dt intervals without a frame, so the video
+    stays time accurate with the difference check and an adaptive interval.
+    With dt=0 the frames are just written one after the other.
+    """
+
+    def __init__(self, write, dt=0, stats=None):
+        self.write, self.dt, self.stats = write, dt, stats if stats is not None else RecordStats()
+        self.start, self.count, self.last = None, 0, None
+
+    def flush(self, timestamp):
+        """Repeat the last frame up to timestamp"""
+        if self.last is None or self.dt <= 0:
+            return
+        target = round((timestamp - self.start) / self.dt)
+        while self.count < target:
+            self.write(self.last)
+            self.count += 1
+            self.stats.repeated += 1
+
+    def __call__(self, timestamp, frame):
+        if self.start is None:
+            self.start = timestamp
+        self.flush(timestamp)
+        self.write(frame)
+        self.count += 1
+        self.last = frame
+
+
+def segment_name(output, index):
+    """out.mp4 -> out_000.mp4"""
+    output = Path(output)
+    return output.with_name('{}_{:03d}{}'.format(output.stem, index, output.suffix))
+
+
+class SegmentWriter:
+    """
+    cv2 VideoWriter that rolls over to a new file every segment_time seconds
+    or segment_size MB. The segments are listed in a csv manifest next to the
+    output, with filename,start,end lines like the ffmpeg segment muxer, but
+    start and end are the wall clock times of the first and the last frame
+    of the segment. Without limits it writes only the output file.
+    """
+
+    def __init__(self, output, framerate, size, segment_time=0, segment_size=0, fourcc='mp4v'):
+        import cv2
+        self.output, self.framerate, self.size = Path(output), framerate, size
+        self.segment_time, self.segment_size = segment_time, segment_size * 2**20
+        self.fourcc = cv2.VideoWriter_fourcc(*fourcc)
+        self.segmented = bool(segment_time or segment_size)
+        self.manifest = self.output.with_suffix('.csv')
+        self.index, self.frames, self.writer, self.first, self.last = 0, 0, None, None, None
+        self.open()
+
+    @property
+    def filename(self):
+        return segment_name(self.output, self.index) if self.segmented else self.output
+
+    def open(self):
+        import cv2
+        logger.debug('open segment "%s"', self.filename)
+        self.writer = cv2.VideoWriter(str(self.filename), self.fourcc, self.framerate, self.size)
+        self.start, self.start_frame = monotonic(), self.frames
+
+    def close(self):
+        self.writer.release()
+        if self.segmented and self.frames > self.start_frame:
+            with open(self.manifest, 'a') as manifest:
+                manifest.write('{},{:.3f},{:.3f}\n'.format(self.filename.name, self.first, self.last))
+
+    def roll(self):
+        if self.segment_time and monotonic() - self.start >= self.segment_time:
+            return True
+        return self.segment_size and self.filename.exists() and self.filename.stat().st_size >= self.segment_size
+
+    def write(self, frame):
+        if self.segmented and self.frames > self.start_frame and self.roll():
+            self.close()
+            self.index += 1
+            self.open()
+        self.writer.write(frame)
+        self.last = time()
+        if self.frames == self.start_frame:
+            self.first = self.last
+        self.frames += 1
+
+    def release(self):
+        self.close()
+
+
+def record_video_writer(open_writer, size=None, dt=1, difference=True, xdisplay=None, running=None,
+                        tile=32, threshold=0, mean=0.0, diff_scale=1, queue_size=8, policy='block', stats=None,
+                        regions=None, monitors=None, windows=None, scale=1, source=None, max_dt=0, backoff=2, fill=False):
+    """
+    Capture with the difference check and write the changed frames to the
+    writer from open_writer((width, height)), a SegmentWriter or PipeWriter.
+
+    max_dt -> back off the capture interval up to max_dt while nothing changes, implies fill
+    fill -> repeat the last frame for every dt without a frame, so the video stays time accurate
+    """
+    fill = fill or bool(max_dt)
+    stats = stats if stats is not None else RecordStats()
+    detector = ChangeDetector(tile, threshold, mean, diff_scale)
+    source = open_source(source, None, xdisplay, 'BGR', stats, capture_regions(size, regions, monitors, windows), scale)
+    frame = source.read()
+    out = open_writer((frame.shape[1], frame.shape[0]))
+    put = FrameFiller(out.write, dt if fill else 0, stats)
+
+    def write(index, timestamp, frame):
+        logger.debug('add frame %i running=%s', index, running)
+        put(timestamp, frame)
+
+    pipeline = FramePipeline(first_then(frame, source.read), write, detector if difference else None, dt, queue_size, policy, 1, running, stats,
+                             max_dt, backoff, None if difference else detector)
+    try:
+        pipeline.run()
+    finally:
+        source.close()
+        put.flush(monotonic())
+        out.release()
+    return stats
+
+
+def record_video_pil(output='out.mp4', size=None, dt=1, framerate=30, difference=True, xdisplay=None, running=None,
+                     segment_time=0, segment_size=0, **kwargs):
+    """
+    Encode with OpenCV into one file or segments, see record_video_writer for the capture options
+    """
     output = Path(output).resolve()
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    out = cv2.VideoWriter(str(output), fourcc, framerate, current_img.size)
     logger.info('start pillow recording with:')
     logger.info('size=%s, framerate=%f, output=%s', size, framerate, output)
-    while running is None or not running.is_set():
-        try:
-            current_img = grab(size, xdisplay=xdisplay)
-            if not difference or current_img != last_img:
-                logger.debug('add frame running=%s', running)
-                frame = np.array(current_img)
-                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                out.write(frame)
-            else:
-                logger.debug('skip frame')
-            last_img = current_img
-            sleep(dt)
-        except KeyboardInterrupt:
-            break
-    logger.info('end pillow recording')
-    out.release()
-
-
-def record_video_ffmpeg(output='out.mp4', filename=':1', f='x11grab', size=(1920, 1080), framerate=1, fps=30, vcodec='libx264', pix_fmt='yuv420p', running=None):
+    stats = record_video_writer(lambda frame_size: SegmentWriter(output, framerate, frame_size, segment_time, segment_size),
+                                size, dt, difference, xdisplay, running, **kwargs)
+    logger.info('end pillow recording %s', stats)
+
+
+def ffmpeg_output_options(output, segment_time=0):
+    """Return the output filename and the ffmpeg options for a single file or segments"""
+    # fragmented mp4 stays playable if ffmpeg gets killed
+    fragmented = output.suffix == '.mp4'
+    options = {'movflags': 'frag_keyframe+empty_moov'} if fragmented else {}
+    if segment_time:
+        options = {
+            'f': 'segment',
+            'segment_time': segment_time,
+            'reset_timestamps': 1,
+            'segment_list': str(output.with_suffix('.csv')),
+            'segment_list_type': 'csv',
+        }
+        if fragmented:
+            options['segment_format_options'] = 'movflags=frag_keyframe+empty_moov'
+        output = output.with_name('{}_%03d{}'.format(output.stem, output.suffix))
+    return output, options
+
+
+def record_video_ffmpeg(output='out.mp4', filename=':1', f='x11grab', size=(1920, 1080), framerate=1, fps=30, vcodec='libx264', pix_fmt='yuv420p', running=None,
+                        segment_time=0, regions=None, monitors=None, windows=None, scale=1, stats=None):
     """
     framerate -> input framrate for recording the screen
     fps -> output framrate for writing the video file
+    segment_time -> start a new file every segment_time seconds
+    regions, monitors, windows -> x11grab records the bounding box of all
+    scale -> scale the video down with area averaging
     """
     output = Path(output).resolve()
+    bboxes = capture_regions(None, regions, monitors, windows)
+    if bboxes:
+        x0, y0, x1, y1 = union_bbox(bboxes)
+        filename, size = '{}+{},{}'.format(filename, x0, y0), (x1 - x0, y1 - y0)
     logger.info('start ffmpeg recording with:')
     logger.info('size=%s, framerate=%f, output=%s', size, framerate, output)
     logger.info('fps=%s, vcodec=%s, pix_fmt=%s, filename=%s, f=%s', fps, vcodec, pix_fmt, filename, f)
 
+    output, options = ffmpeg_output_options(output, segment_time)
     stream = ffmpeg.input(filename=filename, f=f, framerate=framerate, video_size=size).setpts('N/TB/{}'.format(fps))
-    stream = ffmpeg.output(stream, str(output), vcodec=vcodec, preset='ultrafast', r=fps, pix_fmt=pix_fmt)
+    if scale != 1:
+        stream = stream.filter('scale', 'trunc(iw*{}/2)*2'.format(scale), 'trunc(ih*{}/2)*2'.format(scale), flags='area')
+    stream = ffmpeg.output(stream, str(output), vcodec=vcodec, preset='ultrafast', r=fps, pix_fmt=pix_fmt, **options)
     process = ffmpeg.run_async(stream, pipe_stdin=True, pipe_stdout=True, pipe_stderr=True, overwrite_output=True)
     try:
         if running is None:
             input('')
         else:
-            while not running.is_set():
-                sleep(1)
+            running.wait()
     except KeyboardInterrupt:
         logger.info('breack with KeyboardInterrupt')
     finally:
         process.communicate(input=b"q")
+        if stats is not None and os.path.isfile(str(output)):
+            stats.bytes_written = os.path.getsize(str(output))
         logger.info('end ffmpeg recording')
 
 
-def record_frames_pil(output='frames', size=(0, 0, 1920, 1080), dt=1, difference=True):
+class PipeWriter:
+    """
+    Encode raw bgr24 frames with ffmpeg. The frames are written into the
+    stdin of ffmpeg, a full pipe blocks only the writer thread of the
+    pipeline, while the capture keeps its schedule.
+    """
+
+    def __init__(self, output, size, framerate=30, vcodec='libx264', preset='veryfast', crf=23, pix_fmt='yuv420p', threads=0, segment_time=0):
+        output, options = ffmpeg_output_options(Path(output), segment_time)
+        stream = ffmpeg.input('pipe:', f='rawvideo', pix_fmt='bgr24', s='{}x{}'.format(*size), framerate=framerate)
+        # yuv420p needs an even width and height
+        stream = stream.filter('pad', 'ceil(iw/2)*2', 'ceil(ih/2)*2')
+        stream = ffmpeg.output(stream, str(output), vcodec=vcodec, preset=preset, crf=crf, pix_fmt=pix_fmt, threads=threads, **options)
+        stream = stream.global_args('-nostats', '-loglevel', 'error')
+        self.process = ffmpeg.run_async(stream, pipe_stdin=True, overwrite_output=True)
+
+    def write(self, frame):
+        import numpy as np
+        if self.process.poll() is not None:
+            raise RuntimeError('ffmpeg exited with {}'.format(self.process.returncode))
+        self.process.stdin.write(np.ascontiguousarray(frame).data)
+
+    def release(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+
+
+def record_video_pipe(output='out.mkv', size=None, dt=1, framerate=30, difference=True, xdisplay=None, running=None,
+                      vcodec='libx264', preset='veryfast', crf=23, pix_fmt='yuv420p', threads=0, segment_time=0, **kwargs):
+    """
+    Capture like record_video_pil, but encode with ffmpeg through a raw video pipe.
+    """
+    output = Path(output).resolve()
+    logger.info('start pipe recording with:')
+    logger.info('size=%s, framerate=%f, output=%s', size, framerate, output)
+    logger.info('vcodec=%s, preset=%s, crf=%s, pix_fmt=%s, threads=%s', vcodec, preset, crf, pix_fmt, threads)
+    stats = record_video_writer(lambda frame_size: PipeWriter(output, frame_size, framerate, vcodec, preset, crf, pix_fmt, threads, segment_time),
+                                size, dt, difference, xdisplay, running, **kwargs)
+    logger.info('end pipe recording %s', stats)
+
+
+def save_frame(filename, frame, fmt='png', level=1):
+    """
+    Save a RGB frame and return the file size.
+
+    level is the zlib level for png and the method (0=fast ... 6=small) for
+    lossless webp, raw writes an uncompressed ppm.
+    """
+    from PIL import Image
+    img = Image.fromarray(frame)
+    if fmt == 'png':
+        img.save(filename, 'PNG', compress_level=level)
+    elif fmt == 'webp':
+        img.save(filename, 'WEBP', lossless=True, method=min(level, 6))
+    elif fmt == 'raw':
+        img.save(filename, 'PPM')
+    else:
+        raise ValueError('unknown frame format "{}"'.format(fmt))
+    return os.path.getsize(filename)
+
+
+def count_frames(output):
+    """Number of the next frame file, the timestamps file does not count"""
+    return sum(1 for name in os.listdir(str(output)) if name != TIMESTAMPS)
+
+
+def record_frames_pil(output='frames', size=(0, 0, 1920, 1080), dt=1, difference=True, tile=32, threshold=0, mean=0.0, diff_scale=1,
+                      queue_size=8, policy='block', workers=1, running=None, stats=None, fmt='png', level=1, pool='thread', queue_mb=None,
+                      regions=None, monitors=None, windows=None, scale=1, source=None, max_dt=0, backoff=2, store=False):
+    """
+    Save the changed frames as numbered files in output, with their capture
+    time in timestamps.csv, or with store=True into a FrameStore, which
+    keeps identical frames once and resumes from the tail of its index.
+    """
+    stats = stats if stats is not None else RecordStats()
+    detector = ChangeDetector(tile, threshold, mean, diff_scale)
+    source = open_source(source, None, None, 'RGB', stats, capture_regions(size, regions, monitors, windows), scale)
     output = Path(output).resolve()
     output.mkdir(parents=True, exist_ok=True)
-    counter = len(list(output.iterdir()))
+    suffix = FRAME_FORMATS[fmt]
+    # the workers start at the first submit from a writer thread, a fork with
+    # the capture and trigger threads running could deadlock
+    executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) if pool == 'process' else None
+
+    def save(filename, frame, fmt, level):
+        if executor is None:
+            return save_frame(filename, frame, fmt, level)
+        return executor.submit(save_frame, filename, frame, fmt, level).result()
+
+    store = FrameStore(output, save, fmt, suffix, level) if store else None
+    counter = store.next_seq if store is not None else count_frames(output)
+    region = ' '.join(map(str, source.size)) if getattr(source, 'size', None) else ''
+    clock = time() - monotonic()
+    capture = source.read
+    if queue_mb:
+        frame = source.read()
+        queue_size = max(1, int(queue_mb * 2**20 // frame.nbytes))
+        capture = first_then(frame, source.read)
     logger.info('start pillow recording with size=%s, dt=%f, output=%s, counter=%i', size, dt, output, counter)
+    logger.info('fmt=%s, level=%i, pool=%s, workers=%i, queue_size=%i, store=%s', fmt, level, pool, workers, queue_size, store is not None)
 
-    current_img = last_img = grab(size)
-    while True:
-        try:
-            current_img = grab(size)
-            if not difference or current_img != last_img:
-                logger.debug('save frame')
-                current_img.save(str(output / '{:06d}.png'.format(counter)))
-                counter += 1
-            else:
-                logger.debug('skip frame')
-            last_img = current_img
-            sleep(dt)
-        except KeyboardInterrupt:
-            break
-    logger.info('end pillow recording with counter=%i', counter)
-
-
-def record_frames_ffmpeg(output='frames', size=(1920, 1080), framerate=1, filename=':1', f='x11grab'):
+    timestamps, lock = (open(str(output / TIMESTAMPS), 'a') if store is None else None), Lock()
+
+    def write(index, timestamp, frame):
+        logger.debug('save frame %i', index)
+        if store is None:
+            name = '{:06d}{}'.format(index, suffix)
+            stats.add('bytes_written', save(str(output / name), frame, fmt, level))
+            with lock:
+                timestamps.write('{},{:.3f}\n'.format(name, clock + timestamp))
+                timestamps.flush()
+            return
+        size = store.put(index, frame, clock + timestamp, region)
+        if not size:
+            stats.add('deduplicated')
+        stats.add('bytes_written', size)
+
+    pipeline = FramePipeline(capture, write, detector if difference else None, dt, queue_size, policy, workers, running, stats,
+                             max_dt, backoff, None if difference else detector)
+    try:
+        counter = pipeline.run(counter)
+    finally:
+        source.close()
+        if store is not None:
+            store.close()
+        if timestamps is not None:
+            timestamps.close()
+        if executor is not None:
+            executor.shutdown()
+    logger.info('end pillow recording with counter=%i %s', counter, stats)
+
+
+def record_frames_ffmpeg(output='frames', size=(1920, 1080), framerate=1, filename=':1', f='x11grab', running=None, stats=None, store=False):
+    """
+    Let ffmpeg write numbered png files, with store=True the raw frames of
+    ffmpeg go into a FrameStore instead.
+    """
+    stats = stats if stats is not None else RecordStats()
+    if store:
+        source = FfmpegSource(filename, f, (0, 0, *size), framerate, 'RGB', stats)
+        return record_frames_pil(output, dt=0, difference=False, running=running, stats=stats, source=source, store=True)
     output = Path(output).resolve()
     output.mkdir(parents=True, exist_ok=True)
-    counter = len(list(output.iterdir()))
+    counter = start = count_frames(output)
     logger.info('start ffmpeg recording with size=%s, framerate=%f, output=%s, counter=%i', size, framerate, output, counter)
 
     stream = ffmpeg.input(filename=filename, f=f, video_size=size, framerate=framerate)
     stream = ffmpeg.output(stream, str(output / '%06d.png'), start_number=counter, r=1)
     process = ffmpeg.run_async(stream, pipe_stdin=True, pipe_stdout=True, pipe_stderr=True, overwrite_output=True)
     try:
-        input('')
+        if running is None:
+            input('')
+        else:
+            running.wait()
     except KeyboardInterrupt:
         logger.info('breack with KeyboardInterrupt')
     finally:
         process.communicate(input=b"q")
-        counter = len(list(output.iterdir())) - 1
+        counter = count_frames(output) - 1
+        stats.written = counter + 1 - start
         logger.info('end ffmpeg recording with counter=%i', counter)
 
 
@@ -112,23 +820,55 @@ def main(argv=None):
     subparsers = parser.add_subparsers(dest='kind')
     subparsers_pil = create_parsers_pil(subparsers)
     subparsers_pil.add_argument('-o', '--output', default=format_now('{}.mp4'), help='output file')
+    create_parsers_video(subparsers_pil)
+    subparsers_pil.add_argument('--segment-size', type=float, default=0, help='start a new file every n MB')
+    subparsers_pipe = create_parsers_pil(subparsers, 'pipe')
+    subparsers_pipe.add_argument('-o', '--output', default=format_now('{}.mkv'), help='output file')
+    subparsers_pipe.add_argument('--vcodec', default='libx264', help='vcodec default=libx264')
+    subparsers_pipe.add_argument('--preset', default='veryfast', help='encoder preset default=veryfast')
+    subparsers_pipe.add_argument('--crf', type=int, default=23, help='constant rate factor default=23')
+    subparsers_pipe.add_argument('--pix_fmt', default='yuv420p', help='pix_fmt')
+    subparsers_pipe.add_argument('--threads', type=int, default=0, help='encoder threads default=0 (auto)')
+    create_parsers_video(subparsers_pipe)
     subparsers_ffmpeg = create_parsers_ffmpeg(subparsers)
     subparsers_ffmpeg.add_argument('-o', '--output', default=format_now('{}.mkv'), help='output file')
+    subparsers_ffmpeg.add_argument('--segment-time', type=float, default=0, help='start a new file every n seconds')
+    create_parsers_capture(subparsers_ffmpeg)
 
     subparsers_pil = create_parsers_pil(subparsers, 'pil-frames')
     subparsers_pil.add_argument('-o', '--output', default=format_now('./frames/{}', '%Y-%m-%d'), help='output dir')
+    subparsers_pil.add_argument('-w', '--workers', type=int, default=1, help='number of frame writers default=1')
+    subparsers_pil.add_argument('--pool', choices=['thread', 'process'], default='thread', help='run the frame writers as threads or processes')
+    subparsers_pil.add_argument('--format', choices=FRAME_FORMATS.keys(), default='png', help='frame format default=png')
+    subparsers_pil.add_argument('--level', type=int, default=1, help='png compress level or webp method default=1')
+    subparsers_pil.add_argument('--queue-mb', type=float, help='limit the frame queue to this many MB')
+    subparsers_pil.add_argument('--store', action='store_true', help='save into a deduplicating frame store with an index')
     subparsers_ffmpeg = create_parsers_ffmpeg(subparsers, 'ffmpeg-frames', ['in'])
     subparsers_ffmpeg.add_argument('-o', '--output', default=format_now('./frames/{}', '%Y-%m-%d'), help='output dir')
+    subparsers_ffmpeg.add_argument('--store', action='store_true', help='save into a deduplicating frame store with an index')
 
     args = parser.parse_args(argv if argv is not None else sys.argv[1:])
+    capture = {}
+    if args.kind in ('pil', 'pipe', 'ffmpeg', 'pil-frames'):
+        capture = {'regions': args.region, 'monitors': args.monitor, 'windows': args.window, 'scale': args.scale}
+    if args.kind in ('pil', 'pipe', 'pil-frames'):
+        capture.update(source=args.source, max_dt=args.max_dt, backoff=args.backoff)
+    if args.kind in ('pil', 'pipe'):
+        capture.update(tile=args.tile, threshold=args.threshold, mean=args.mean, diff_scale=args.diff_scale,
+                       queue_size=args.queue_size, policy=args.policy, segment_time=args.segment_time, fill=args.fill)
     if args.kind == 'pil':
-        record_video_pil(args.output, args.size, args.dt, args.framerate, args.difference)
+        record_video_pil(args.output, args.size, args.dt, args.framerate, args.difference, segment_size=args.segment_size, **capture)
+    elif args.kind == 'pipe':
+        record_video_pipe(args.output, args.size, args.dt, args.framerate, args.difference,
+                          vcodec=args.vcodec, preset=args.preset, crf=args.crf, pix_fmt=args.pix_fmt, threads=args.threads, **capture)
     elif args.kind == 'ffmpeg':
-        record_video_ffmpeg(args.output, args.filename, args.f, args.size, 1 / args.dt, args.framerate, args.vcodec, args.pix_fmt)
+        record_video_ffmpeg(args.output, args.filename, args.f, args.size, 1 / args.dt, args.framerate, args.vcodec, args.pix_fmt,
+                            segment_time=args.segment_time, **capture)
     elif args.kind == 'pil-frames':
-        record_frames_pil(args.output, args.size, args.dt, args.difference)
+        record_frames_pil(args.output, args.size, args.dt, args.difference, args.tile, args.threshold, args.mean, args.diff_scale,
+                          args.queue_size, args.policy, args.workers, fmt=args.format, level=args.level, pool=args.pool, queue_mb=args.queue_mb, store=args.store, **capture)
     elif args.kind == 'ffmpeg-frames':
-        record_frames_ffmpeg(args.output, args.size, 1 / args.dt, args.filename, args.f)
+        record_frames_ffmpeg(args.output, args.size, 1 / args.dt, args.filename, args.f, store=args.store)
     else:
         parser.print_help()
 
@@ -0,0 +1,117 @@
+import os
+import heapq
+import hashlib
+from pathlib import Path
+from threading import Lock, get_ident
+
+INDEX = 'index.csv'
+
+
+def is_store(directory):
+    return (Path(directory) / INDEX).is_file()
+
+
+class FrameStore:
+    """
+    Content addressed frame store.
+
+    Every frame is saved once as objects/<hash[:2]>/<hash[2:]><suffix>, named
+    by the hash of its raw pixels, so identical frames share one file across
+    all sessions and a duplicate costs a hash and a stat instead of an
+    encode. index.csv is append only with one 'seq,hash,suffix,timestamp,
+    region' line per frame. Opening a store only reads the tail of the index,
+    so resuming does not depend on the number of frames.
+    """
+    tail = 65536
+
+    def __init__(self, directory, save=None, fmt='png', suffix='.png', level=1):
+        self.directory, self.save, self.fmt, self.suffix, self.level = Path(directory), save, fmt, suffix, level
+        self.objects = self.directory / 'objects'
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.lock, self.index = Lock(), None
+        self.next_seq = self.last_seq() + 1
+
+    def last_seq(self):
+        """Highest sequence in the tail of the index, the workers may append a little out of order"""
+        try:
+            with open(self.directory / INDEX, 'rb') as index:
+                size = index.seek(0, os.SEEK_END)
+                index.seek(max(0, size - self.tail))
+                lines = index.read().split(b'\n')
+        except FileNotFoundError:
+            return -1
+        if size > self.tail:
+            lines = lines[1:]
+        seqs = []
+        for line in lines:
+            fields = line.split(b',')
+            # skip a half written last line
+            if len(fields) == 5 and fields[0].isdigit():
+                seqs.append(int(fields[0]))
+        return max(seqs, default=-1)
+
+    def blob(self, digest, suffix=None):
+        return self.objects / digest[:2] / (digest[2:] + (suffix or self.suffix))
+
+    @staticmethod
+    def digest(frame):
+        data = memoryview(frame).cast('B') if frame.flags.c_contiguous else frame.tobytes()
+        return hashlib.blake2b(data, digest_size=16, person='x'.join(map(str, frame.shape)).encode()[:16]).hexdigest()
+
+    def append(self, seq, digest, timestamp, region=''):
+        with self.lock:
+            if self.index is None:
+                self.index = open(self.directory / INDEX, 'a+b')
+                end = self.index.tell()
+                if end:
+                    # a crash may have left half a line
+                    self.index.seek(end - 1)
+                    if self.index.read(1) != b'\n':
+                        self.index.write(b'\n')
+            self.index.write('{},{},{},{:.3f},{}\n'.format(seq, digest, self.suffix, timestamp, region).encode())
+            self.index.flush()
+
+    def put(self, seq, frame, timestamp, region=''):
+        """Store the frame under seq and return the bytes written, 0 for a known frame"""
+        digest, size = self.digest(frame), 0
+        path = self.blob(digest)
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            tmp = path.with_name('{}.{}.tmp'.format(path.name, get_ident()))
+            size = self.save(str(tmp), frame, self.fmt, self.level)
+            os.replace(str(tmp), str(path))
+        self.append(seq, digest, timestamp, region)
+        return size
+
+    def entries(self, window=1024):
+        """Yield (seq, path, timestamp, region) of the index in sequence order"""
+        try:
+            index = open(self.directory / INDEX)
+        except FileNotFoundError:
+            return
+        heap = []
+        with index:
+            for line in index:
+                parts = line.rstrip('\n').split(',')
+                if len(parts) != 5:
+                    continue
+                try:
+                    item = (int(parts[0]), str(self.blob(parts[1], parts[2])), float(parts[3]), parts[4])
+                except ValueError:
+                    continue
+                if len(heap) < window:
+                    heapq.heappush(heap, item)
+                else:
+                    yield heapq.heappushpop(heap, item)
+        while heap:
+            yield heapq.heappop(heap)
+
+    def frames(self):
+        for _, path, _, _ in self.entries():
+            yield path
+
+    def close(self):
+        with self.lock:
+            if self.index is not None:
+                self.index.close()
+                self.index = None
@@ -1,79 +1,292 @@
-from datetime import datetime, timedelta
+import os
+import ctypes
+from ctypes.util import find_library
 from logging import getLogger
+from pathlib import PurePath
+from threading import Event
+from time import monotonic
 
-from pynput import mouse, keyboard
 
+from watchdog.events import PatternMatchingEventHandler
 from watchdog.observers import Observer
+from watchdog.observers.polling import PollingObserver
 
-
-from .utils import BasicTrigger, FileSystemHandler, check_processes
+from .config import Config
+from .utils import BasicTrigger, count_dirs
+from .procs import ProcessIndex, ProcConnector, check_processes
 
 logger = getLogger(__name__)
 
 
 class ProcessesTrigger(BasicTrigger):
-    """docstring for ProcessesTrigger."""
+    """
+    Check the process rules whenever processes start or exit. With the Linux
+    process connector it reacts to the kernel events and does nothing while
+    there are none, otherwise it compares the pid list every dt seconds and
+    only looks at the new pids. Every full_dt seconds the whole index is
+    verified, for reused pids, missed events and changed open files.
+    """
+    full_dt = 30
+
+    def check(self, index):
+        for profile in self.profiles:
+            self.action(profile.name, not profile.proc_rules or check_processes(
+                profile.required_proc,
+                profile.required_files,
+                profile.banned_proc,
+                profile.banned_files,
+                index)
+            )
 
     def run(self):
         self.logger.debug('run thread')
+        index = ProcessIndex()
+        try:
+            connector = ProcConnector()
+        except (OSError, AttributeError) as exc:
+            self.logger.info('no process connector (%s), poll the pid list', exc)
+            connector = None
+        changed, pids, config, next_full = True, set(), self.config, 0
         while not self.running.is_set():
-            for name, conf in self.config.items():
-                self.action(name, check_processes(
-                    conf.get('required_proc', []),
-                    conf.get('required_proc_files', []),
-                    conf.get('banned_proc', []),
-                    conf.get('banned_proc_files', []))
-                )
-            self.wait()
+            verify = monotonic() >= next_full
+            if verify:
+                next_full = monotonic() + self.full_dt
+            if connector is None or pids or verify:
+                try:
+                    changed = index.update(any(profile.proc_files for profile in self.profiles), pids, verify) or changed
+                except Exception as exc:
+                    self.logger.warning('process scan failed: %s', exc)
+            if changed or config is not self.config:
+                config = self.config
+                self.check(index)
+                changed = False
+            if connector is None:
+                self.wait()
+            else:
+                self.tick_done()
+                # short timeout, so close() does not wait for dt
+                pids = connector.wait(min(self.dt, 1))
+                self.tick_start()
+        if connector is not None:
+            connector.close()
+
+
+class FileSystemHandler(PatternMatchingEventHandler):
+    """
+    Forward the matching events to on_action. watchdog matches the patterns
+    only against the end of a path, so the events below the ignore_dirs are
+    dropped by the names of the path components below root.
+    """
+
+    def __init__(self, name, on_action, patterns=['*.py'], ignore_patterns=None, ignore_dirs=(), root=None):
+        super().__init__(patterns=patterns, ignore_patterns=ignore_patterns, ignore_directories=True, case_sensitive=False)
+        self.name, self.on_action, self.ignore_dirs = name, on_action, frozenset(ignore_dirs)
+        self.root = PurePath(os.path.abspath(root)) if root else None
+
+    def ignored(self, path):
+        path = PurePath(os.path.abspath(path))
+        if self.root is not None:
+            try:
+                path = path.relative_to(self.root)
+            except ValueError:
+                pass
+        return not self.ignore_dirs.isdisjoint(path.parts[:-1])
+
+    def on_any_event(self, event):
+        if self.ignored(event.src_path):
+            return
+        self.on_action(self.name, event)
 
 
 class FileSystemTrigger(BasicTrigger):
-    """docstring for ProcessesTrigger."""
+    """
+    Activate a profile on changes in its file_system_dir and deactivate it
+    file_system_dt seconds after the last change.
+
+    The watchdog callback only stores a monotonic timestamp and wakes the
+    thread if the profile is not active yet, so a storm of events costs one
+    dict assignment per event. The state changes happen in run() at most
+    once per file_system_debounce seconds.
+    """
+    ignore_dirs = ('.git', '.hg', '.svn', '.tox', 'node_modules', '__pycache__', 'build', 'dist', 'venv', '.venv')
+
+    def __init__(self, config, on_trigger, dt=5):
+        self.last, self.wakeup = {}, Event()
+        self.received, self.coalesced = 0, 0
+        super().__init__(config, on_trigger, dt)
 
     def on_action(self, name, event):
-        self.last[name] = datetime.now()
-        self.action(name, True)
+        self.received += 1
+        self.last[name] = monotonic()
+        if name in self._actions or self.wakeup.is_set():
+            self.coalesced += 1
+        else:
+            self.wakeup.set()
+
+    def close(self):
+        super().close()
+        self.wakeup.set()
+
+    def metrics(self):
+        return dict(super().metrics(), received=self.received, coalesced=self.coalesced)
+
+    def create_observer(self, dirname, conf):
+        kind, limit = conf.get('file_system_observer', 'auto'), conf.get('file_system_watch_limit')
+        if kind == 'auto' and limit and count_dirs(dirname, limit) > limit:
+            self.logger.info('more than %i directories in "%s", use polling', limit, dirname)
+            kind = 'polling'
+        if kind == 'polling':
+            return kind, PollingObserver(timeout=conf.get('file_system_poll_dt', self.dt))
+        if kind == 'inotify':
+            from watchdog.observers.inotify import InotifyObserver
+            return kind, InotifyObserver()
+        return 'auto', Observer()
+
+    def start_observers(self, profiles):
+        observers = {}
+        for profile in profiles:
+            dirname = profile.conf.get('file_system_dir')
+            if dirname:
+                kind, observer = self.create_observer(dirname, profile.conf)
+                observer = observers.setdefault(kind, observer)
+                handler = FileSystemHandler(profile.name, self.on_action, profile.conf.get('file_system_patterns', ['*.py']),
+                                            profile.conf.get('file_system_ignore'), profile.conf.get('file_system_ignore_dirs', self.ignore_dirs), dirname)
+                observer.schedule(handler, dirname, recursive=True)
+        for observer in observers.values():
+            observer.start()
+        return observers
+
+    @staticmethod
+    def stop_observers(observers):
+        for observer in observers.values():
+            observer.stop()
+        for observer in observers.values():
+            observer.join()
 
     def run(self):
         self.logger.debug('run thread')
-        self.last = {}
-        observer = Observer()
-        for name, conf in self.config.items():
-            dirname = conf.get('file_system_dir')
-            if dirname:
-                observer.schedule(FileSystemHandler(name, self.on_action, conf.get('file_system_patterns', ['*.py'])), dirname, recursive=True)
-        observer.start()
+        config, observers, debounce = None, {}, 1
         try:
             while not self.running.is_set():
-                for name, last in self.last.items():
-                    if datetime.now() - last > timedelta(seconds=self.config[name].get('file_system_dt', 300)):
-                        self.action(name, False)
-                self.wait()
-        except:
-            observer.stop()
-            print("Observer Stopped")
-        observer.join()
+                if config is not self.config:
+                    # the observers are set up again with the new config
+                    self.stop_observers(observers)
+                    config = self.config
+                    observers = self.start_observers(self.profiles)
+                    debounce = min([profile.conf.get('file_system_debounce', 1) for profile in self.profiles] or [1])
+                    self.last = {name: last for name, last in self.last.items() if name in config}
+                self.wakeup.clear()
+                now = monotonic()
+                for name, last in list(self.last.items()):
+                    self.action(name, now - last <= config[name].get('file_system_dt', 300))
+                self.logger.debug('events received=%i coalesced=%i', self.received, self.coalesced)
+                self.tick_done()
+                if self.running.wait(debounce):
+                    break
+                self.wakeup.wait(max(0, self.dt - debounce))
+                self.tick_start()
+        finally:
+            self.stop_observers(observers)
+
+
+class XIdleInfo(ctypes.Structure):
+    _fields_ = [
+        ('window', ctypes.c_ulong),
+        ('state', ctypes.c_int),
+        ('kind', ctypes.c_int),
+        ('til_or_since', ctypes.c_ulong),
+        ('idle', ctypes.c_ulong),
+        ('event_mask', ctypes.c_ulong),
+    ]
+
+
+class XIdle:
+    """User idle time in seconds from the X server (XScreenSaver extension)"""
+
+    def __init__(self, display=None):
+        try:
+            self.xlib = ctypes.cdll.LoadLibrary(find_library('X11') or 'libX11.so.6')
+            self.xss = ctypes.cdll.LoadLibrary(find_library('Xss') or 'libXss.so.1')
+        except OSError as exc:
+            raise OSError('can not load libX11/libXss: {}'.format(exc)) from exc
+        self.xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        self.xlib.XOpenDisplay.restype = ctypes.c_void_p
+        self.xlib.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        self.xlib.XDefaultRootWindow.restype = ctypes.c_ulong
+        self.xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        self.xlib.XFree.argtypes = [ctypes.c_void_p]
+        self.xss.XScreenSaverQueryExtension.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int)]
+        self.xss.XScreenSaverAllocInfo.restype = ctypes.POINTER(XIdleInfo)
+        self.xss.XScreenSaverQueryInfo.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(XIdleInfo)]
+
+        self.display = self.xlib.XOpenDisplay(display.encode() if display else None)
+        if not self.display:
+            raise OSError('can not open display {}'.format(display or os.environ.get('DISPLAY')))
+        event, error = ctypes.c_int(), ctypes.c_int()
+        if not self.xss.XScreenSaverQueryExtension(self.display, ctypes.byref(event), ctypes.byref(error)):
+            self.xlib.XCloseDisplay(self.display)
+            raise OSError('no XScreenSaver extension')
+        self.root = self.xlib.XDefaultRootWindow(self.display)
+        self.info = self.xss.XScreenSaverAllocInfo()
+
+    def __call__(self):
+        self.xss.XScreenSaverQueryInfo(self.display, self.root, self.info)
+        return self.info.contents.idle / 1000
+
+    def close(self):
+        self.xlib.XFree(self.info)
+        self.xlib.XCloseDisplay(self.display)
 
 
 class MouseKeyboardTrigger(BasicTrigger):
-    """docstring for MouseKeyboardTrigger."""
+    """
+    Activate profiles on user input and deactivate them after
+    mouse_keyboard_dt seconds without input.
+
+    The input callback only stores a monotonic timestamp, the state changes
+    happen in run(). With mouse_keyboard_mode = "xidle" the idle time is
+    read from the X server and no input hooks are installed at all.
+    """
+
+    def __init__(self, config, on_trigger, dt=1):
+        self.last = None
+        super().__init__(config, on_trigger, dt)
 
     def on_action(self, *args):
-        self.last = datetime.now()
-        for name in self.config.keys():
-            self.action(name, True)
+        self.last = monotonic()
+
+    def idle_hooks(self):
+        return None if self.last is None else monotonic() - self.last
 
     def run(self):
         self.logger.debug('run thread')
-        self.last = datetime.now()
-        mouse.Listener(on_move=self.on_action, on_click=self.on_action, on_scroll=self.on_action).start()
-        keyboard.Listener(on_press=self.on_action, on_release=self.on_action).start()
-        while not self.running.is_set():
-            dt = datetime.now() - self.last
-            for name, conf in self.config.items():
-                if dt > timedelta(seconds=conf.get('mouse_keyboard_dt', 60)):
-                    self.action(name, False)
-            self.wait()
+        modes = [profile.conf['mouse_keyboard_mode'] for profile in self.profiles if 'mouse_keyboard_mode' in profile.conf]
+        listeners, xidle, idle = [], None, self.idle_hooks
+        if 'xidle' in modes:
+            try:
+                xidle = idle = XIdle()
+            except OSError as exc:
+                self.logger.warning('no X idle time (%s), use input hooks', exc)
+        if xidle is None:
+            # pynput needs a display already on import
+            from pynput import mouse, keyboard
+            listeners = [
+                mouse.Listener(on_move=self.on_action, on_click=self.on_action, on_scroll=self.on_action),
+                keyboard.Listener(on_press=self.on_action, on_release=self.on_action),
+            ]
+            for listener in listeners:
+                listener.start()
+        try:
+            while not self.running.is_set():
+                dt = idle()
+                for profile in self.profiles:
+                    self.action(profile.name, dt is not None and dt <= profile.conf.get('mouse_keyboard_dt', 60))
+                self.wait()
+        finally:
+            for listener in listeners:
+                listener.stop()
+            if xidle is not None:
+                xidle.close()
 
 
 def on_trigger(sender, name, event):
@@ -81,15 +294,15 @@ def on_trigger(sender, name, event):
 
 
 if __name__ == '__main__':
-    # trigger = MouseKeyboardTrigger({'test': {'mouse_keyboard_dt': 1}}, on_trigger)
-    trigger = ProcessesTrigger({
+    # trigger = MouseKeyboardTrigger(Config({'test': {'mouse_keyboard_dt': 1}}), on_trigger)
+    trigger = ProcessesTrigger(Config({
         'test': {
             'required_proc': ["atom"],
             'required_proc_files': ['/home/axju/projects/socialpy/.git/objects'],
             'banned_proc': ["firefox"],
             'banned_proc_files': ['/home/axju/projects/horn']
         }
-    }, on_trigger)
-    # trigger = FileSystemTrigger({'test': {'file_system_dir': '/home/axju/projects/screenio', 'file_system_dt': 5}}, on_trigger)
+    }), on_trigger)
+    # trigger = FileSystemTrigger(Config({'test': {'file_system_dir': '/home/axju/projects/screenio', 'file_system_dt': 5}}), on_trigger)
     input('wait')
     trigger.close()
@@ -1,13 +1,19 @@
+import os
+import re
 import logging
+import subprocess
+import queue
+import multiprocessing
 from importlib import import_module
 from importlib.metadata import entry_points
+from inspect import signature, Parameter
 from pathlib import Path
 from datetime import datetime
-from time import sleep
-from threading import Thread, Event
-
-import psutil
-from watchdog.events import PatternMatchingEventHandler
+from time import monotonic
+from math import ceil
+from bisect import bisect_left
+from collections import deque
+from threading import Thread, Event, Condition, Lock
 
 
 logger = logging.getLogger(__name__)
@@ -15,6 +21,7 @@ logger = logging.getLogger(__name__)
 FUNCS_MAP = {
     'video-pil': 'screenio.record.record_video_pil',
     'video-ffmpeg': 'screenio.record.record_video_ffmpeg',
+    'video-pipe': 'screenio.record.record_video_pipe',
     'frames-pil': 'screenio.record.record_frames_pil',
     'frames-ffmpeg': 'screenio.record.record_frames_ffmpeg',
 }
@@ -26,6 +33,35 @@ def create_parsers_pil(parser, name='pil'):
     subparsers.add_argument('-t', '--dt', type=float, default=1, help='delta time default=1')
     subparsers.add_argument('-f', '--framerate', type=int, default=30, help='framerate default=30')
     subparsers.add_argument('-d', '--difference', action='store_false', help='disabel difference check')
+    subparsers.add_argument('--tile', type=int, default=32, help='tile size for the difference check default=32')
+    subparsers.add_argument('--threshold', type=int, default=0, help='skip frames with less or equal changed tiles default=0')
+    subparsers.add_argument('--mean', type=float, default=0.0, help='use the mean absolute difference as threshold instead of tiles')
+    subparsers.add_argument('--diff-scale', type=int, default=1, help='average n x n pixels before the diff, hides small changes: 1 level on one pixel is missed with 4 default=1')
+    subparsers.add_argument('--queue-size', type=int, default=8, help='max frames waiting for the writer default=8')
+    subparsers.add_argument('--policy', choices=FrameQueue.policies, default='block', help='what to do with a full queue default=block')
+    subparsers.add_argument('--max-dt', type=float, default=0, help='back off the capture interval up to n seconds while the screen does not change')
+    subparsers.add_argument('--backoff', type=float, default=2, help='factor of the interval back off default=2')
+    create_parsers_capture(subparsers)
+    create_parsers_source(subparsers)
+    return subparsers
+
+
+def create_parsers_capture(subparsers):
+    subparsers.add_argument('--region', type=int, nargs=4, action='append', metavar=('X', 'Y', 'W', 'H'), help='capture region, repeat for more')
+    subparsers.add_argument('--monitor', type=int, action='append', help='capture monitor by xrandr index, repeat for more')
+    subparsers.add_argument('--window', action='append', help='capture X window by id or title, repeat for more')
+    subparsers.add_argument('--scale', type=float, default=1, help='scale the frames before diff and encoding default=1')
+    return subparsers
+
+
+def create_parsers_video(subparsers):
+    subparsers.add_argument('--segment-time', type=float, default=0, help='start a new file every n seconds')
+    subparsers.add_argument('--fill', action='store_true', help='repeat the last frame while nothing is captured, keeps the video time accurate')
+    return subparsers
+
+
+def create_parsers_source(subparsers):
+    subparsers.add_argument('--source', help='capture source: pil (default), xshm, ffmpeg:<format>:<input> or hub:<name>')
     return subparsers
 
 
@@ -54,9 +90,13 @@ def setup_logger(level=0, logger_name=''):
     _logger.addHandler(ch)
 
 
-def load_entry_points():
-    """get all entry points"""
-    return {enp.name: enp.load() for enp in entry_points()['screenio.register_cmd']}
+def load_entry_points(group='screenio.register_cmd'):
+    """get all entry points, a command module is only imported by enp.load()"""
+    try:
+        enps = entry_points(group=group)
+    except TypeError:
+        enps = entry_points().get(group, [])
+    return {enp.name: enp for enp in enps}
 
 
 def load_func(name):
@@ -79,29 +119,39 @@ def format_now(format_str='{}.mp4', format_datetime='%Y-%m-%d_%H-%M-%S'):
     return format_str.format(datetime.now().strftime(format_datetime))
 
 
-def check_processes(required=[], required_files=[], banned=[], banned_files=[]):
-    if not required and not required_files and not required_files and not banned_files:
-        return True
-    processes, processes_files = [], []
-    try:
-        for proc in psutil.process_iter():
-            if proc.name() in required:
-                processes.append(proc.name())
-            if proc.name() in banned:
-                return False
-            try:
-                for item in proc.open_files():
-                    for name in required_files:
-                        if item.path.startswith(name):
-                            processes_files.append(name)
-                    for name in banned_files:
-                        if item.path.startswith(name):
-                            return False
-            except Exception:
-                pass
-    except Exception:
-        return True
-    return len(set(processes)) == len(required) and len(set(processes_files)) == len(required_files)
+def list_monitors():
+    """Return the bboxes (x0, y0, x1, y1) of the monitors from xrandr"""
+    output = subprocess.run(['xrandr', '--listmonitors'], capture_output=True, text=True, check=True).stdout
+    monitors = []
+    for match in re.finditer(r'(\d+)/\d+x(\d+)/\d+\+(\d+)\+(\d+)', output):
+        width, height, x, y = map(int, match.groups())
+        monitors.append((x, y, x + width, y + height))
+    return monitors
+
+
+def window_bbox(window):
+    """Return the bbox (x0, y0, x1, y1) of a X window by id or title from xwininfo"""
+    window = str(window)
+    args = ['-id', window] if re.fullmatch(r'0x[0-9a-fA-F]+|\d+', window) else ['-name', window]
+    output = subprocess.run(['xwininfo'] + args, capture_output=True, text=True, check=True).stdout
+    info = dict(re.findall(r'^\s*(Absolute upper-left [XY]|Width|Height):\s*(-?\d+)', output, re.MULTILINE))
+    x, y = int(info['Absolute upper-left X']), int(info['Absolute upper-left Y'])
+    return (x, y, x + int(info['Width']), y + int(info['Height']))
+
+
+def capture_regions(size=None, regions=None, monitors=None, windows=None):
+    """
+    Collect the capture bboxes (x0, y0, x1, y1) from a size bbox, regions
+    (x, y, w, h), monitor indices and window ids or titles. An empty list
+    means the full screen. Windows are looked up once, at the start.
+    """
+    bboxes = [tuple(size)] if size else []
+    bboxes += [(x, y, x + w, y + h) for x, y, w, h in regions or []]
+    if monitors:
+        available = list_monitors()
+        bboxes += [available[index] for index in monitors]
+    bboxes += [window_bbox(window) for window in windows or []]
+    return bboxes
 
 
 def check_triggers(current, target):
@@ -111,6 +161,7 @@ def check_triggers(current, target):
 
 
 def check_open_file(fpath):
+    import psutil
     path = str(fpath)
     for proc in psutil.process_iter():
         try:
@@ -122,64 +173,418 @@ def check_open_file(fpath):
     return False
 
 
-class FileSystemHandler(PatternMatchingEventHandler):
+class Scheduler:
+    """
+    Fixed rate timer on the monotonic clock.
+
+    wait() sleeps until the next tick, so the work between two calls does not
+    stretch the interval. Ticks that already passed are skipped and counted
+    in missed. It returns False as soon as the running event is set.
+
+    With max_dt the interval is adaptive: slow_down() multiplies it by
+    backoff up to max_dt and reset() goes back to dt.
+    """
+
+    def __init__(self, dt=1, running=None, max_dt=None, backoff=2):
+        self.dt, self.running = dt, running if running is not None else Event()
+        self.interval, self.max_dt, self.backoff = dt, max(dt, max_dt or 0), backoff
+        self.next_time, self.ticks, self.missed = monotonic(), 0, 0
+
+    def slow_down(self):
+        self.interval = min(self.interval * self.backoff, self.max_dt)
 
-    def __init__(self, name, on_action, patterns=['*.py']):
-        super().__init__(patterns=patterns, ignore_directories=True, case_sensitive=False)
-        self.name, self.on_action = name, on_action
+    def reset(self):
+        self.interval = self.dt
 
-    def on_any_event(self, event):
-        self.on_action(self.name, event)
+    def wait(self):
+        self.ticks += 1
+        if self.interval <= 0:
+            return not self.running.is_set()
+        self.next_time += self.interval
+        delay = self.next_time - monotonic()
+        if delay < 0:
+            missed = ceil(-delay / self.interval)
+            self.missed += missed
+            self.next_time += missed * self.interval
+            delay = self.next_time - monotonic()
+        return not self.running.wait(max(0, delay))
+
+
+class RecordStats:
+    """Counter for the recording functions, the latency of every stage is also kept as histogram"""
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+    def __init__(self):
+        self.start, self.lock = monotonic(), Lock()
+        self.captured, self.skipped, self.written, self.bytes_copied, self.bytes_written = 0, 0, 0, 0, 0
+        self.dropped, self.missed, self.errors, self.repeated, self.queue_depth = 0, 0, 0, 0, 0
+        self.deduplicated = 0
+        self.interval = 0.0
+        self.latency, self.histogram = {}, {}
+
+    @property
+    def fps(self):
+        duration = monotonic() - self.start
+        return self.captured / duration if duration > 0 else 0.0
+
+    def add(self, counter, value=1):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + value)
+
+    def add_latency(self, stage, seconds):
+        with self.lock:
+            count, total, maximum = self.latency.get(stage, (0, 0.0, 0.0))
+            self.latency[stage] = (count + 1, total + seconds, max(maximum, seconds))
+            histogram = self.histogram.setdefault(stage, [0] * (len(self.buckets) + 1))
+            histogram[bisect_left(self.buckets, seconds)] += 1
+
+    def as_dict(self):
+        data = {
+            'captured': self.captured,
+            'skipped': self.skipped,
+            'written': self.written,
+            'dropped': self.dropped,
+            'missed': self.missed,
+            'errors': self.errors,
+            'repeated': self.repeated,
+            'deduplicated': self.deduplicated,
+            'bytes_copied': self.bytes_copied,
+            'bytes_written': self.bytes_written,
+            'queue_depth': self.queue_depth,
+            'interval': self.interval,
+            'fps': self.fps,
+            'write_mb_per_s': self.bytes_written / 2**20 / max(monotonic() - self.start, 1e-9),
+        }
+        for stage, (count, total, maximum) in sorted(self.latency.items()):
+            data['{}_avg_ms'.format(stage)] = total / count * 1000
+            data['{}_max_ms'.format(stage)] = maximum * 1000
+        return data
+
+    def snapshot(self):
+        """as_dict with the latency histograms, {stage: {'buckets': counts, 'sum': seconds}}"""
+        with self.lock:
+            latency = {stage: {'buckets': list(self.histogram[stage]), 'sum': total} for stage, (count, total, maximum) in self.latency.items()}
+        return dict(self.as_dict(), latency=latency)
+
+    def __str__(self):
+        return ', '.join('{}={}'.format(key, round(value, 2)) for key, value in self.as_dict().items())
+
+
+class FrameQueue:
+    """
+    Bounded queue between the capture and the writer threads.
+
+    If the queue is full, policy 'block' waits for a free slot, 'drop-oldest'
+    replaces the oldest waiting frame and 'drop-newest' discards the new one.
+    """
+    policies = ('block', 'drop-oldest', 'drop-newest')
+
+    def __init__(self, maxsize=8, policy='block', stats=None):
+        if policy not in self.policies:
+            raise ValueError('unknown drop policy "{}"'.format(policy))
+        self.maxsize, self.policy = max(1, maxsize), policy
+        self.stats = stats if stats is not None else RecordStats()
+        self.items, self.cond, self.closed = deque(), Condition(), False
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item):
+        with self.cond:
+            if len(self.items) >= self.maxsize:
+                if self.policy == 'drop-newest':
+                    self.stats.add('dropped')
+                    return False
+                if self.policy == 'drop-oldest':
+                    self.items.popleft()
+                    self.stats.add('dropped')
+                while len(self.items) >= self.maxsize and not self.closed:
+                    self.cond.wait()
+            self.items.append(item)
+            self.stats.queue_depth = len(self.items)
+            self.cond.notify_all()
+            return True
+
+    def get(self):
+        """Return the next item or None if the queue is closed and empty"""
+        with self.cond:
+            while not self.items and not self.closed:
+                self.cond.wait()
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            self.stats.queue_depth = len(self.items)
+            self.cond.notify_all()
+            return item
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class FramePipeline:
+    """
+    Capture frames on a fixed monotonic schedule and hand them over to writer threads.
+
+    capture() returns a frame or raises EOFError at the end, select(frame)
+    decides if it is kept and write(index, timestamp, frame) is called by the
+    workers. Frames are numbered in capture order, so several workers may
+    write in parallel.
+
+    With max_dt the capture interval backs off while the frames do not
+    change and goes back to dt on the first change. activity(frame) decides
+    what a change is, by default the result of select.
+    """
+
+    def __init__(self, capture, write, select=None, dt=1, queue_size=8, policy='block', workers=1, running=None, stats=None,
+                 max_dt=None, backoff=2, activity=None):
+        self.capture, self.write, self.select, self.dt = capture, write, select, dt
+        self.max_dt, self.backoff, self.activity = max_dt, backoff, activity
+        self.stats = stats if stats is not None else RecordStats()
+        self.queue = FrameQueue(queue_size, policy, self.stats)
+        self.workers, self.running = max(1, workers), running if running is not None else Event()
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            index, timestamp, frame = item
+            start = monotonic()
+            self.stats.add_latency('queue', start - timestamp)
+            try:
+                self.write(index, timestamp, frame)
+                self.stats.add('written')
+            except Exception as exc:
+                logger.exception('write frame %i failed: %s', index, exc)
+                self.stats.add('errors')
+            self.stats.add_latency('write', monotonic() - start)
+
+    def run(self, index=0):
+        threads = [Thread(target=self.worker, daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        scheduler = Scheduler(self.dt, self.running, self.max_dt, self.backoff)
+        try:
+            while not self.running.is_set():
+                start = monotonic()
+                frame = self.capture()
+                captured = monotonic()
+                self.stats.add_latency('capture', captured - start)
+                keep = self.select is None or self.select(frame)
+                if keep:
+                    self.queue.put((index, start, frame))
+                    index += 1
+                else:
+                    self.stats.add('skipped')
+                if self.max_dt:
+                    changed = keep if self.activity is None or self.activity is self.select else self.activity(frame)
+                    if changed:
+                        scheduler.reset()
+                    else:
+                        scheduler.slow_down()
+                    self.stats.interval = scheduler.interval
+                self.stats.add_latency('diff', monotonic() - captured)
+
+                missed = scheduler.missed
+                if not scheduler.wait():
+                    break
+                self.stats.add('missed', scheduler.missed - missed)
+        except EOFError as exc:
+            logger.info('capture ended: %s', exc)
+        except KeyboardInterrupt:
+            logger.info('break with KeyboardInterrupt')
+        finally:
+            self.queue.close()
+            for thread in threads:
+                thread.join()
+        return index
+
+
+def count_dirs(path, limit=None):
+    """Count the directories below path, stop counting above limit"""
+    counter = 0
+    for _, dirnames, _ in os.walk(path):
+        counter += len(dirnames)
+        if limit is not None and counter > limit:
+            break
+    return counter
 
 
 class BasicTrigger(Thread):
-    """docstring for MouseKeyboardTrigger."""
+    """
+    Base class of the triggers. config is a screenio.config.Config, the
+    trigger thread only looks at the profiles of config.select(). reload()
+    swaps the config, the state of the changed profiles is dropped by the
+    trigger thread, so they are activated again if the trigger still fires.
+    """
 
     def __init__(self, config, on_trigger, dt=5):
         super().__init__()
         self.logger = logging.getLogger('.'.join([__name__, self.__class__.__name__]))
         self.config, self.on_trigger, self.dt = config, on_trigger, dt
         self._actions, self.running = [], Event()
+        self._changed, self._lock = set(), Lock()
+        self.scheduler = Scheduler(dt, self.running)
+        self.ticks, self.tick_seconds, self.tick_max, self.events, self._tick = 0, 0.0, 0.0, 0, monotonic()
         self.start()
 
+    def tick_done(self):
+        """Count the work since the last tick_start(), call it before the trigger thread sleeps"""
+        seconds = monotonic() - self._tick
+        self.ticks, self.tick_seconds, self.tick_max = self.ticks + 1, self.tick_seconds + seconds, max(self.tick_max, seconds)
+
+    def tick_start(self):
+        self._tick = monotonic()
+
+    def metrics(self):
+        return {'ticks': self.ticks, 'tick_seconds': self.tick_seconds, 'tick_max_seconds': self.tick_max, 'events': self.events}
+
+    @property
+    def profiles(self):
+        return self.config.select(self.__class__.__name__)
+
+    def reload(self, config, changed=()):
+        with self._lock:
+            self._changed.update(changed)
+            self.config = config
+
     def wait(self):
-        for _ in range(self.dt):
-            sleep(1)
+        self.tick_done()
+        result = self.scheduler.wait()
+        self.tick_start()
+        return result
 
     def close(self):
         self.logger.debug('stop thread')
         self.running.set()
 
     def action(self, name, event):
+        if self._changed:
+            with self._lock:
+                changed, self._changed = self._changed, set()
+            self._actions = [item for item in self._actions if item not in changed]
         if event and name not in self._actions:
+            self.events += 1
             self.on_trigger(self.__class__.__name__, name, True)
             self._actions.append(name)
         elif not event and name in self._actions:
+            self.events += 1
             self.on_trigger(self.__class__.__name__, name, False)
             self._actions.remove(name)
 
 
-class FuncRunner(Thread):
+def call_recorder(func, kwargs, running, stats):
+    """Call func with the running event and with stats, if its signature takes it"""
+    try:
+        params = signature(func).parameters.values()
+    except (TypeError, ValueError):
+        params = []
+    if any(param.name == 'stats' or param.kind == Parameter.VAR_KEYWORD for param in params):
+        kwargs = dict(kwargs, stats=stats)
+    return func(**kwargs, running=running)
+
+
+def run_func_process(func, kwargs, running, status, interval=1):
+    """Target of the recorder process, it sends the stats to the status queue"""
+    stats, done = RecordStats(), Event()
 
-    def __init__(self, func='screenio.record.record_video_pil', directory='.', filename='{}.mp4', kwargs={}):
+    def report():
+        while not done.wait(interval):
+            status.put(stats.snapshot())
+
+    reporter = Thread(target=report, daemon=True)
+    reporter.start()
+    try:
+        func = load_func(func) if isinstance(func, str) else func
+        call_recorder(func, kwargs, running, stats)
+    except Exception as exc:
+        status.put(dict(stats.snapshot(), error=repr(exc)))
+        raise
+    finally:
+        done.set()
+        reporter.join()
+    status.put(stats.snapshot())
+
+
+class FuncRunner(Thread):
+    """
+    Run a recording function with a running event and, if it takes one, a
+    RecordStats object.
+
+    With process=True the function runs in its own spawned process, so the
+    CPU heavy capture and encoding does not compete with the trigger threads
+    for the GIL. The stop event is a multiprocessing event then and the stats
+    are sent back through a queue. status returns the last stats either way.
+    """
+    stop_timeout = 30
+
+    def __init__(self, func='screenio.record.record_video_pil', directory='.', filename='{}.mp4', kwargs={}, process=False):
         super().__init__()
-        self.running = Event()
-        if isinstance(func, str):
-            self.func = load_func(func)
-        else:
+        self.process, self.error, self.stats, self._status = None, None, RecordStats(), {}
+        if process:
+            self.context = multiprocessing.get_context('spawn')
+            self.running, self.queue = self.context.Event(), self.context.Queue()
             self.func = func
+        else:
+            self.running = Event()
+            if isinstance(func, str):
+                self.func = load_func(func)
+            else:
+                self.func = func
+        self.use_process = process
 
         directory = Path(directory).resolve()
         directory.mkdir(parents=True, exist_ok=True)
 
-        self.kwargs = kwargs
+        self.kwargs = dict(kwargs)
         self.kwargs['output'] = str(Path(directory).resolve() / format_now(filename))
         self.start()
 
+    @property
+    def status(self):
+        status = dict(self._status) if self.use_process else self.stats.snapshot()
+        if self.error is not None:
+            status['error'] = self.error
+        return status
+
     def stop(self):
         logger.debug('stop thread')
         self.running.set()
 
+    def drain(self, timeout=0):
+        try:
+            while True:
+                self._status = self.queue.get(timeout=timeout)
+                self.error = self._status.get('error', self.error)
+                timeout = 0
+        except queue.Empty:
+            pass
+
     def run(self):
         logger.debug('run thread')
-        self.func(**self.kwargs, running=self.running)
+        if not self.use_process:
+            try:
+                call_recorder(self.func, self.kwargs, self.running, self.stats)
+            except Exception as exc:
+                logger.exception('recorder failed: %s', exc)
+                self.error = repr(exc)
+            return
+
+        self.process = self.context.Process(target=run_func_process, args=(self.func, self.kwargs, self.running, self.queue), daemon=True)
+        self.process.start()
+        stopped = None
+        while self.process.is_alive():
+            self.drain(timeout=0.5)
+            if self.running.is_set():
+                stopped = stopped or monotonic()
+                if monotonic() - stopped > self.stop_timeout:
+                    logger.warning('terminate recorder process %i', self.process.pid)
+                    self.process.terminate()
+                    break
+        self.process.join()
+        self.drain()
+        if self.process.exitcode and self.error is None:
+            self.error = 'exit code {}'.format(self.process.exitcode)
+        logger.debug('recorder process exit code %s', self.process.exitcode)
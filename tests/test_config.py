@@ -0,0 +1,99 @@
+import os
+import tempfile
+import unittest
+
+import toml
+
+from screenio.config import Config
+from screenio.octopus import Octopus
+
+PROFILES = {
+    'default': {'func': 'video-pil'},
+    'work': {'triggers': ['MouseKeyboardTrigger', 'ProcessesTrigger'], 'required_proc': ['code']},
+    'code': {'triggers': ['FileSystemTrigger'], 'file_system_dir': '.'},
+    'any': {'directory': 'any'},
+}
+
+
+class FakeWorker:
+
+    def __init__(self):
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+
+class TestConfig(unittest.TestCase):
+
+    def test_active(self):
+        config = Config(PROFILES)
+        work, anything = config.profiles['work'], config.profiles['any']
+        mouse, procs, files = (config.bit(name) for name in ('MouseKeyboardTrigger', 'ProcessesTrigger', 'FileSystemTrigger'))
+        self.assertFalse(work.active(mouse))
+        self.assertFalse(work.active(mouse | files))
+        self.assertTrue(work.active(mouse | procs))
+        self.assertTrue(anything.active(files))
+        self.assertTrue(anything.active(config.bit('other')))
+        self.assertFalse(anything.active(0))
+
+    def test_defaults(self):
+        config = Config(PROFILES)
+        self.assertEqual(config['code']['func'], 'video-pil')
+        self.assertEqual(set(config), {'work', 'code', 'any'})
+        self.assertEqual([profile.name for profile in config.select('ProcessesTrigger')], ['work', 'any'])
+
+    def test_diff(self):
+        data = dict(PROFILES, code=dict(PROFILES['code'], file_system_dir='src'), new={'func': 'frames-pil'})
+        del data['any']
+        self.assertEqual(Config(PROFILES).diff(Config(data)), {'code', 'new', 'any'})
+        self.assertEqual(Config(PROFILES).diff(Config(PROFILES)), set())
+        changed_default = dict(PROFILES, default={'func': 'video-pipe'})
+        self.assertEqual(Config(PROFILES).diff(Config(changed_default)), {'work', 'code', 'any'})
+
+
+class TestOctopusReload(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.toml')
+        os.close(fd)
+        self.write(PROFILES)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def write(self, data):
+        with open(self.filename, 'w') as fh:
+            toml.dump(data, fh)
+
+    def test_reload_keeps_unchanged_recorders(self):
+        octopus = Octopus(self.filename)
+        config = octopus.config
+        workers = {name: FakeWorker() for name in ('work', 'code', 'any')}
+        octopus.worker.update(workers)
+        work_mask = config.mask(['MouseKeyboardTrigger', 'ProcessesTrigger'])
+        octopus.trigger.update(work=work_mask, code=config.bit('FileSystemTrigger'), any=config.bit('ProcessesTrigger'))
+
+        self.write(dict(PROFILES, code=dict(PROFILES['code'], file_system_dir='src')))
+        octopus.reload()
+
+        self.assertIsNot(octopus.config, config)
+        self.assertEqual(set(octopus.worker), {'work', 'any'})
+        self.assertIs(octopus.worker['work'], workers['work'])
+        self.assertFalse(workers['work'].stopped)
+        self.assertTrue(workers['code'].stopped)
+        self.assertEqual(octopus.stopping, [workers['code']])
+        self.assertNotIn('code', octopus.trigger)
+        self.assertEqual(octopus.trigger['work'], octopus.config.mask(['MouseKeyboardTrigger', 'ProcessesTrigger']))
+
+    def test_reload_keeps_config_on_error(self):
+        octopus = Octopus(self.filename)
+        config = octopus.config
+        with open(self.filename, 'w') as fh:
+            fh.write('[work\n')
+        octopus.reload()
+        self.assertIs(octopus.config, config)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import json
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import mock
+
+from screenio.convert import CHECK_INDEX, check_videos_ffmpeg, frame_counts, group_videos, iter_timed_frames
+from screenio.record import TIMESTAMPS
+
+H264 = {'codec_name': 'h264', 'profile': 'High', 'width': 640, 'height': 480}
+SMALL = dict(H264, width=320, height=240)
+
+
+class TestGroupVideos(unittest.TestCase):
+
+    def test_runs(self):
+        records = {'3.mp4': SMALL, '1.mp4': H264, '2.mp4': dict(H264), '4.mp4': H264, '5.mp4': H264}
+        self.assertEqual(group_videos(records), [['1.mp4', '2.mp4'], ['3.mp4'], ['4.mp4', '5.mp4']])
+
+    def test_profile_splits(self):
+        records = {'1.mp4': H264, '2.mp4': dict(H264, profile='Main')}
+        self.assertEqual(group_videos(records), [['1.mp4'], ['2.mp4']])
+        self.assertEqual(group_videos({}), [])
+
+
+class TestCheckCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        for name in ('1.mp4', '2.mp4', '.hidden'):
+            (self.directory / name).write_bytes(b'video')
+        patcher = mock.patch('screenio.convert.ProcessPoolExecutor', ThreadPoolExecutor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(str(self.directory))
+
+    def check(self, full=False, broken=()):
+        def inspect(filename, full=False):
+            return None if Path(filename).name in broken else H264
+        with mock.patch('screenio.convert.inspect_video_ffmpeg', side_effect=inspect) as inspect_mock:
+            records = check_videos_ffmpeg(self.directory, 2, full)
+        return records, sorted(Path(call.args[0]).name for call in inspect_mock.call_args_list)
+
+    def test_unchanged_files_are_cached(self):
+        records, checked = self.check(broken={'2.mp4'})
+        self.assertEqual(checked, ['1.mp4', '2.mp4'])
+        self.assertEqual(records, {str(self.directory / '1.mp4'): H264})
+        index = json.loads((self.directory / CHECK_INDEX).read_text())
+        self.assertEqual(set(index), {'1.mp4', '2.mp4'})
+        self.assertIsNone(index['2.mp4']['params'])
+
+        records, checked = self.check()
+        self.assertEqual(checked, [])
+        self.assertEqual(list(records), [str(self.directory / '1.mp4')])
+
+    def test_key_and_full(self):
+        self.check()
+        (self.directory / '2.mp4').write_bytes(b'longer video')
+        (self.directory / '1.mp4').unlink()
+        records, checked = self.check()
+        self.assertEqual(checked, ['2.mp4'])
+        self.assertEqual(set(json.loads((self.directory / CHECK_INDEX).read_text())), {'2.mp4'})
+        # a cheap check does not count for full=True
+        self.assertEqual(self.check(full=True)[1], ['2.mp4'])
+        self.assertEqual(self.check(full=True)[1], [])
+        self.assertEqual(self.check()[1], [])
+
+
+class TestFrameCounts(unittest.TestCase):
+
+    def test_gaps(self):
+        frames = [('a', 100.0), ('b', 100.5), ('c', 100.6), ('d', 103.0)]
+        self.assertEqual(list(frame_counts(frames, 10)), [('a', 5), ('b', 1), ('c', 24), ('d', 1)])
+
+    def test_no_drift(self):
+        frames = [(index, index / 3) for index in range(31)]
+        counts = [count for _, count in frame_counts(frames, 10)]
+        self.assertEqual(sum(counts[:-1]), 100)
+        self.assertEqual(set(counts[:-1]), {3, 4})
+
+    def test_max_gap_and_missing(self):
+        frames = [('a', 0.0), ('b', 3600.0), ('c', None), ('d', 3600.5)]
+        self.assertEqual(list(frame_counts(frames, 2, max_gap=10)), [('a', 20), ('b', 1), ('c', 1), ('d', 1)])
+        self.assertEqual(list(frame_counts([], 2)), [])
+
+
+class TestTimedFrames(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(str(self.directory))
+
+    def test_timestamps_csv(self):
+        for name in ('000000.png', '000002.png', '000003.png'):
+            (self.directory / name).write_bytes(b'png')
+        (self.directory / TIMESTAMPS).write_text('000000.png,100.000\n000002.png,101.500\n000003.png,10')
+        frames = [(Path(filename).name, timestamp) for filename, timestamp in iter_timed_frames(self.directory)]
+        self.assertEqual(frames, [('000000.png', 100.0), ('000002.png', 101.5), ('000003.png', 10.0)])
+        (self.directory / TIMESTAMPS).unlink()
+        self.assertEqual([timestamp for _, timestamp in iter_timed_frames(self.directory)], [None] * 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,25 @@
+import sys
+import subprocess
+import unittest
+
+HEAVY = ['cv2', 'numpy', 'moviepy', 'ffmpeg', 'PIL', 'pynput', 'watchdog', 'psutil', 'toml']
+
+
+def run_python(code):
+    return subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+
+
+class TestMain(unittest.TestCase):
+
+    def test_no_heavy_imports(self):
+        code = 'import sys, screenio.__main__ as m; m.create_parser(m.load_entry_points().keys()); print(",".join(sys.modules))'
+        modules = run_python(code).strip().split(',')
+        self.assertEqual([name for name in modules if name.split('.')[0] in HEAVY], [])
+
+    def test_import_time(self):
+        code = 'from time import perf_counter; t = perf_counter(); import screenio.__main__; print(perf_counter() - t)'
+        self.assertLess(float(run_python(code)), 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
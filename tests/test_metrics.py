@@ -0,0 +1,32 @@
+import unittest
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from screenio.metrics import MetricsServer
+
+
+class TestProfile(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MetricsServer(None, '127.0.0.1:0')
+        self.addCleanup(self.server.close)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server.server_address[1])
+
+    def status(self, path):
+        try:
+            with urlopen(self.url + path, timeout=5) as response:
+                return response.status
+        except HTTPError as exc:
+            return exc.code
+
+    def test_bad_seconds(self):
+        for seconds in ('abc', 'nan', '-1', '0'):
+            self.assertEqual(self.status('/profile?seconds=' + seconds), 400, seconds)
+
+    def test_profile(self):
+        self.assertEqual(self.status('/profile?seconds=0.05'), 200)
+        self.assertEqual(self.status('/other'), 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
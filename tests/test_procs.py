@@ -0,0 +1,115 @@
+import sys
+import types
+import unittest
+from unittest import mock
+
+from screenio.procs import ProcessIndex, check_processes
+
+
+def build_index(procs, files):
+    index = ProcessIndex()
+    for pid, name in procs.items():
+        index.names.setdefault(name, set()).add(pid)
+    index.paths = sorted((path, pid) for pid, paths in files.items() for path in paths)
+    return index
+
+
+class TestCheckProcesses(unittest.TestCase):
+
+    def setUp(self):
+        self.index = build_index(
+            {1: 'init', 10: 'code', 11: 'code', 20: 'firefox'},
+            {10: ['/home/user/project/main.py', '/home/user/project/utils.py'], 20: ['/home/user/.mozilla/places.sqlite']},
+        )
+
+    def check(self, required=[], required_files=[], banned=[], banned_files=[]):
+        return check_processes(required, required_files, banned, banned_files, self.index)
+
+    def test_no_rules(self):
+        self.assertTrue(check_processes(index=self.index))
+
+    def test_required(self):
+        self.assertTrue(self.check(['code']))
+        self.assertTrue(self.check(['code', 'firefox']))
+        self.assertFalse(self.check(['code', 'vim']))
+
+    def test_banned(self):
+        self.assertFalse(self.check(['code'], banned=['firefox']))
+        self.assertTrue(self.check(['code'], banned=['vim']))
+
+    def test_path_prefix(self):
+        self.assertTrue(self.check(required_files=['/home/user/project/']))
+        self.assertTrue(self.check(required_files=['/home/user/project/utils.py']))
+        self.assertFalse(self.check(required_files=['/home/user/other/']))
+        self.assertFalse(self.check(['code'], banned_files=['/home/user/.mozilla']))
+        self.assertTrue(self.check(['code'], banned_files=['/home/user/.ssh']))
+
+
+class FakePsutil(types.ModuleType):
+    """psutil with a table of pid: (name, create_time) that counts the lookups"""
+
+    Error = LookupError
+
+    def __init__(self, table):
+        super().__init__('psutil')
+        self.table, self.lookups = table, []
+
+    def pids(self):
+        return list(self.table)
+
+    def Process(self, pid):
+        psutil = self
+        psutil.lookups.append(pid)
+        if pid not in psutil.table:
+            raise LookupError(pid)
+
+        class Process:
+            def name(self):
+                return psutil.table[pid][0]
+
+            def create_time(self):
+                return psutil.table[pid][1]
+        return Process()
+
+
+class TestProcessIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.psutil = FakePsutil({1: ('init', 0), 10: ('bash', 5), 11: ('code', 6)})
+        patcher = mock.patch.dict(sys.modules, psutil=self.psutil)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.index = ProcessIndex()
+        self.index.update()
+        self.index.update()
+        self.psutil.lookups.clear()
+
+    def test_unchanged_table_is_not_read(self):
+        self.assertFalse(self.index.update())
+        self.assertEqual(self.psutil.lookups, [])
+
+    def test_recheck_exec(self):
+        self.psutil.table[10] = ('vim', 5)
+        self.assertTrue(self.index.update(recheck={10}))
+        self.assertEqual(self.index.names['vim'], {10})
+        self.assertNotIn('bash', self.index.names)
+        self.assertEqual(set(self.psutil.lookups), {10})
+
+    def test_reused_pid(self):
+        self.psutil.table[11] = ('firefox', 9)
+        # only the pids of the events or a full verify look at create_time
+        self.assertFalse(self.index.update())
+        self.assertTrue(self.index.update(verify=True))
+        self.assertEqual(self.index.names['firefox'], {11})
+        self.assertNotIn('code', self.index.names)
+
+    def test_new_and_gone(self):
+        del self.psutil.table[10]
+        self.psutil.table[12] = ('sh', 7)
+        self.assertTrue(self.index.update())
+        self.assertEqual(set(self.index.procs), {1, 11, 12})
+        self.assertEqual(self.psutil.lookups, [12])
+
+
+if __name__ == '__main__':
+    unittest.main()
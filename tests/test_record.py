@@ -0,0 +1,119 @@
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+
+from screenio.record import ChangeDetector, FrameFiller, SegmentWriter
+from screenio.utils import RecordStats
+
+
+class TestFrameFiller(unittest.TestCase):
+
+    def fill(self, dt, frames, end):
+        written, stats = [], RecordStats()
+        put = FrameFiller(written.append, dt, stats)
+        for timestamp, frame in frames:
+            put(timestamp, frame)
+        put.flush(end)
+        return written, stats
+
+    def test_repeat_until_next_frame(self):
+        written, stats = self.fill(0.5, [(10.0, 'a'), (11.0, 'b'), (11.6, 'c')], 13.1)
+        self.assertEqual(written, ['a', 'a', 'b', 'c', 'c', 'c'])
+        self.assertEqual(stats.repeated, 3)
+
+    def test_no_fill(self):
+        written, stats = self.fill(0, [(10.0, 'a'), (15.0, 'b')], 20.0)
+        self.assertEqual(written, ['a', 'b'])
+        self.assertEqual(stats.repeated, 0)
+
+    def test_late_frame_is_not_dropped(self):
+        # a frame earlier than its slot is written anyway, the video only gets longer
+        written, _ = self.fill(1, [(0.0, 'a'), (0.2, 'b'), (0.4, 'c'), (2.0, 'd')], 2.0)
+        self.assertEqual(written, ['a', 'b', 'c', 'd'])
+
+
+def screen(height=64, width=96):
+    return np.full((height, width, 3), 100, np.uint8)
+
+
+def changed(frame, *pixels, delta=1):
+    frame = frame.copy()
+    for y, x in pixels:
+        frame[y, x, 2] += delta
+    return frame
+
+
+class TestChangeDetector(unittest.TestCase):
+
+    def test_first_and_same(self):
+        detector = ChangeDetector(32)
+        self.assertTrue(detector(screen()))
+        self.assertFalse(detector(screen()))
+
+    def test_tile_threshold(self):
+        detector = ChangeDetector(32, threshold=1)
+        detector(screen())
+        # the last channel of the last column is the end of a row in the (h, w * channels) view
+        self.assertFalse(detector(changed(screen(), (0, 95))))
+        self.assertEqual(detector.changed_tiles, 1)
+        self.assertTrue(detector(changed(screen(), (0, 95), (40, 0))))
+        self.assertEqual(detector.changed_tiles, 2)
+        # the accepted frame is the new reference
+        self.assertFalse(detector(changed(screen(), (0, 95), (40, 0))))
+
+    def test_mean(self):
+        detector = ChangeDetector(32, mean=0.5)
+        detector(screen())
+        self.assertFalse(detector(changed(screen(), (0, 0), delta=100)))
+        self.assertTrue(detector(screen() + 1))
+        self.assertAlmostEqual(detector.mean_diff, 1.0)
+
+    def test_shape_change(self):
+        detector = ChangeDetector(32, threshold=100)
+        detector(screen())
+        self.assertTrue(detector(screen(32, 48)))
+        self.assertFalse(detector(screen(32, 48)))
+
+    def test_scale_hides_small_changes(self):
+        detector = ChangeDetector(8, scale=4)
+        detector(screen())
+        self.assertFalse(detector(changed(screen(), (5, 5))))
+        self.assertTrue(detector(changed(screen(), (5, 5), delta=16)))
+        self.assertEqual(detector.last.shape, (16, 24, 3))
+        detector = ChangeDetector(8)
+        detector(screen())
+        self.assertTrue(detector(changed(screen(), (5, 5))))
+
+
+class TestSegmentWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(str(self.directory))
+
+    def test_manifest_wall_clock(self):
+        clock = [1000.0]
+        with mock.patch('screenio.record.monotonic', lambda: clock[0]), mock.patch('screenio.record.time', lambda: clock[0] + 5e8):
+            writer = SegmentWriter(self.directory / 'out.mp4', 30, (32, 16), segment_time=10)
+            for offset in (0, 4, 9.5, 12, 15, 25):
+                clock[0] = 1000.0 + offset
+                writer.write(screen(16, 32))
+            clock[0] = 1030.0
+            writer.release()
+        lines = (self.directory / 'out.csv').read_text().splitlines()
+        self.assertEqual(lines, [
+            'out_000.mp4,500001000.000,500001009.500',
+            'out_001.mp4,500001012.000,500001015.000',
+            'out_002.mp4,500001025.000,500001025.000',
+        ])
+        self.assertTrue((self.directory / 'out_002.mp4').is_file())
+
+
+if __name__ == '__main__':
+    unittest.main()
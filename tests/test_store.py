@@ -0,0 +1,88 @@
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from screenio.store import FrameStore, INDEX, is_store
+
+
+def save_raw(filename, frame, fmt, level):
+    data = frame.tobytes()
+    with open(filename, 'wb') as fh:
+        fh.write(data)
+    return len(data)
+
+
+def frame(value, shape=(4, 6, 3)):
+    return np.full(shape, value, np.uint8)
+
+
+class TestFrameStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(str(self.directory))
+
+    def store(self):
+        return FrameStore(self.directory, save_raw, 'raw', '.raw')
+
+    def blobs(self):
+        return [path for path in (self.directory / 'objects').rglob('*') if path.is_file()]
+
+    def test_dedup(self):
+        store = self.store()
+        sizes = [store.put(seq, frame(value), 1000 + seq) for seq, value in enumerate([1, 2, 1, 1, 2])]
+        store.close()
+        self.assertEqual(sizes, [72, 72, 0, 0, 0])
+        self.assertEqual(len(self.blobs()), 2)
+        self.assertTrue(is_store(self.directory))
+
+        # same bytes in another shape are another frame
+        store = self.store()
+        self.assertEqual(store.put(5, frame(1, (6, 4, 3)), 1005), 72)
+        # known frames of an earlier session are not written again
+        self.assertEqual(store.put(6, frame(2), 1006), 0)
+        store.close()
+        self.assertEqual(len(self.blobs()), 3)
+
+    def test_entries_in_order(self):
+        store = self.store()
+        for seq in (0, 2, 1, 3):
+            store.put(seq, frame(seq), 1000 + seq, '0 0 6 4')
+        store.close()
+        entries = list(self.store().entries())
+        self.assertEqual([entry[0] for entry in entries], [0, 1, 2, 3])
+        self.assertEqual(entries[1][2:], (1001.0, '0 0 6 4'))
+        self.assertEqual(open(entries[3][1], 'rb').read(), frame(3).tobytes())
+
+    def test_resume_from_tail(self):
+        store = self.store()
+        for seq in range(50):
+            store.put(seq, frame(seq % 3), seq)
+        store.close()
+        store = self.store()
+        store.tail = 200
+        self.assertEqual(store.last_seq(), 49)
+        self.assertEqual(store.next_seq, 50)
+        self.assertEqual(FrameStore(self.directory / 'new').next_seq, 0)
+
+    def test_half_written_line(self):
+        store = self.store()
+        for seq in range(3):
+            store.put(seq, frame(seq), seq)
+        store.close()
+        with open(str(self.directory / INDEX), 'ab') as fh:
+            fh.write(b'99,0123')
+        store = self.store()
+        self.assertEqual(store.next_seq, 3)
+        store.put(3, frame(3), 3)
+        store.close()
+        self.assertEqual([entry[0] for entry in self.store().entries()], [0, 1, 2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import unittest
+
+from watchdog.events import FileModifiedEvent
+
+from screenio.triggers import FileSystemHandler, FileSystemTrigger
+
+
+class TestFileSystemHandler(unittest.TestCase):
+
+    def dispatch(self, *paths, root='/r'):
+        events = []
+        handler = FileSystemHandler('test', lambda name, event: events.append(event.src_path), ['*.py'], None, FileSystemTrigger.ignore_dirs, root)
+        for path in paths:
+            handler.dispatch(FileModifiedEvent(path))
+        return events
+
+    def test_nested_ignored(self):
+        paths = ['/r/node_modules/a/b/x.py', '/r/.git/objects/ab/cd.py', '/r/src/build/lib/x.py', '/r/__pycache__/x.py']
+        self.assertEqual(self.dispatch(*paths), [])
+
+    def test_matching(self):
+        self.assertEqual(self.dispatch('/r/x.py', '/r/src/a/y.py', '/r/src/z.txt'), ['/r/x.py', '/r/src/a/y.py'])
+
+    def test_root_inside_ignored_dir(self):
+        self.assertEqual(self.dispatch('/home/build/project/x.py', root='/home/build/project'), ['/home/build/project/x.py'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import unittest
+from threading import Thread, Event, Timer
+from time import monotonic
+from unittest import mock
+
+from screenio.utils import FrameQueue, RecordStats, Scheduler
+
+
+class TestFrameQueue(unittest.TestCase):
+
+    def fill(self, policy, count=5, maxsize=3):
+        stats = RecordStats()
+        queue = FrameQueue(maxsize, policy, stats)
+        results = [queue.put(item) for item in range(count)]
+        return queue, stats, results
+
+    def test_drop_oldest(self):
+        queue, stats, results = self.fill('drop-oldest')
+        self.assertEqual(results, [True] * 5)
+        self.assertEqual(list(queue.items), [2, 3, 4])
+        self.assertEqual(stats.dropped, 2)
+        self.assertEqual(stats.queue_depth, 3)
+
+    def test_drop_newest(self):
+        queue, stats, results = self.fill('drop-newest')
+        self.assertEqual(results, [True, True, True, False, False])
+        self.assertEqual(list(queue.items), [0, 1, 2])
+        self.assertEqual(stats.dropped, 2)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            FrameQueue(policy='drop-all')
+
+    def test_block_until_get(self):
+        queue, stats, _ = self.fill('block', 3)
+        thread = Thread(target=queue.put, args=(3,))
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+        self.assertEqual(queue.get(), 0)
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(list(queue.items), [1, 2, 3])
+        self.assertEqual(stats.dropped, 0)
+
+    def test_close_unblocks(self):
+        queue = FrameQueue(1)
+        queue.put(0)
+        putter = Thread(target=queue.put, args=(1,))
+        putter.start()
+        putter.join(0.1)
+        self.assertTrue(putter.is_alive())
+        queue.close()
+        putter.join(1)
+        self.assertFalse(putter.is_alive())
+
+        empty, results = FrameQueue(1), []
+        getter = Thread(target=lambda: results.append(empty.get()))
+        getter.start()
+        getter.join(0.1)
+        self.assertTrue(getter.is_alive())
+        empty.close()
+        getter.join(1)
+        self.assertEqual(results, [None])
+
+    def test_drain_after_close(self):
+        queue, _, _ = self.fill('block', 2)
+        queue.close()
+        self.assertEqual([queue.get(), queue.get(), queue.get()], [0, 1, None])
+
+
+class FakeRunning:
+    """Running event that records the delays instead of sleeping"""
+
+    def __init__(self):
+        self.delays = []
+
+    def wait(self, delay):
+        self.delays.append(delay)
+        return False
+
+    def is_set(self):
+        return False
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_missed_ticks(self):
+        clock, running = [100.0], FakeRunning()
+        with mock.patch('screenio.utils.monotonic', lambda: clock[0]):
+            scheduler = Scheduler(1, running)
+            clock[0] = 100.25
+            self.assertTrue(scheduler.wait())
+            self.assertEqual(scheduler.missed, 0)
+            # the work took 3.5 intervals, the ticks at 102 to 104 are skipped
+            clock[0] = 104.5
+            self.assertTrue(scheduler.wait())
+        self.assertEqual(scheduler.missed, 3)
+        self.assertEqual(scheduler.next_time, 105)
+        self.assertEqual(running.delays, [0.75, 0.5])
+        self.assertEqual(scheduler.ticks, 2)
+
+    def test_backoff(self):
+        scheduler = Scheduler(1, max_dt=5, backoff=2)
+        scheduler.slow_down()
+        scheduler.slow_down()
+        self.assertEqual(scheduler.interval, 4)
+        scheduler.slow_down()
+        self.assertEqual(scheduler.interval, 5)
+        scheduler.reset()
+        self.assertEqual(scheduler.interval, 1)
+
+    def test_stop_immediately(self):
+        running = Event()
+        running.set()
+        start = monotonic()
+        self.assertFalse(Scheduler(10, running).wait())
+        self.assertFalse(Scheduler(0, running).wait())
+        self.assertLess(monotonic() - start, 1)
+
+    def test_stop_while_waiting(self):
+        running = Event()
+        timer = Timer(0.05, running.set)
+        timer.start()
+        start = monotonic()
+        self.assertFalse(Scheduler(10, running).wait())
+        self.assertLess(monotonic() - start, 5)
+        timer.join()
+
+
+if __name__ == '__main__':
+    unittest.main()